@@ -0,0 +1,120 @@
+import argparse
+import os
+import time
+
+from instrument import instrument
+from pipeline import LazyPipeline
+
+
+### 批处理入口：读取三个原始数据文件，执行清洗流程，按指定格式逐块写出结果，不加载绘图库
+# 可输出的表，见pipeline.OUTPUT_STAGES
+BATCH_OUTPUTS = ['received_response', 'transaction_response', 'cid_features']
+# 输出格式及文件扩展名
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'jsonl': '.jsonl'}
+
+
+def write_csv(df, path, chunk_rows):
+    ''' 逐块追加写csv，每块只转换chunk_rows行
+    '''
+    with open(path, 'w', newline='') as f:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            df.iloc[start:start + chunk_rows].to_csv(f, index=False, header=(start == 0))
+
+def write_jsonl(df, path, chunk_rows):
+    ''' 逐块追加写json-lines，每行一条记录
+    '''
+    with open(path, 'w') as f:
+        for start in range(0, len(df), chunk_rows):
+            lines = df.iloc[start:start + chunk_rows].to_json(orient='records', lines=True)
+            f.write(lines if lines.endswith('\n') else lines + '\n')
+
+def write_parquet(df, path, chunk_rows):
+    ''' 逐块写parquet，每块为一个row group；依赖pyarrow
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # 按整张表推断字段类型，避免第一块全为空的字段被推断为null类型
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(path, schema) as writer:
+        for start in range(0, len(df), chunk_rows):
+            writer.write_table(pa.Table.from_pandas(df.iloc[start:start + chunk_rows], schema=schema, \
+                                                    preserve_index=False))
+
+WRITERS = {'csv': write_csv, 'parquet': write_parquet, 'jsonl': write_jsonl}
+
+
+def export(df, out_dir, name, formats, chunk_rows=100000):
+    ''' 把一张表按各格式写出
+    Args:
+        df(df): 要写出的表
+        out_dir(string): 输出目录
+        name(string): 文件名(不含扩展名)
+        formats(list): 输出格式，见FORMATS
+        chunk_rows(int): 每块写出的行数
+    Returns:
+        paths(list): 写出的文件路径
+    '''
+    paths = []
+    for fmt in formats:
+        path = os.path.join(out_dir, name + FORMATS[fmt])
+        WRITERS[fmt](df, path, chunk_rows)
+        paths.append(path)
+    return paths
+
+def run_batch(portfolio_path, profile_path, transcript_path, out_dir, outputs=BATCH_OUTPUTS, formats=['csv'], \
+              chunksize=500000, chunk_rows=100000, stage_log=None, encode_ids=False):
+    ''' 执行清洗流程并写出结果
+    Args:
+        portfolio_path, profile_path, transcript_path(string): 三个原始数据文件路径
+        out_dir(string): 输出目录
+        outputs(list): 需要输出的表，见BATCH_OUTPUTS
+        formats(list): 输出格式，见FORMATS
+        chunksize(int): 分批读取profile、transcript的记录条数
+        chunk_rows(int): 每块写出的行数
+        stage_log(string): 各清洗函数耗时的json-lines日志路径，默认不记录
+        encode_ids(bool): 是否把id编码为整数编码后再计算，见LazyPipeline
+    Returns:
+        paths(list): 写出的文件路径
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    plan = LazyPipeline(portfolio_path, profile_path, transcript_path, chunksize=chunksize, encode_ids=encode_ids)
+    for output in outputs:
+        plan.select(output)
+
+    if stage_log is None:
+        results = plan.collect()
+    else:
+        with instrument(stage_log, trace_memory=False):
+            results = plan.collect()
+
+    paths = []
+    for output in outputs:
+        paths += export(results.pop(output), out_dir, output, formats, chunk_rows)
+    return paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='星巴克数据清洗批处理：输出offer响应记录和用户统计')
+    parser.add_argument('--portfolio', default='data/portfolio.json')
+    parser.add_argument('--profile', default='data/profile.json')
+    parser.add_argument('--transcript', default='data/transcript.json')
+    parser.add_argument('--out-dir', default='output', help='输出目录')
+    parser.add_argument('--outputs', nargs='+', choices=BATCH_OUTPUTS, default=BATCH_OUTPUTS)
+    parser.add_argument('--formats', nargs='+', choices=list(FORMATS), default=['csv'])
+    parser.add_argument('--chunksize', type=int, default=500000, help='分批读取的记录条数')
+    parser.add_argument('--chunk-rows', type=int, default=100000, help='每块写出的行数')
+    parser.add_argument('--stage-log', default=None, help='各清洗函数耗时的json-lines日志路径')
+    parser.add_argument('--encode-ids', action='store_true', help='id编码为整数编码后再计算，transcript中的用户须都在profile中')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    paths = run_batch(args.portfolio, args.profile, args.transcript, args.out_dir, outputs=args.outputs, \
+                      formats=args.formats, chunksize=args.chunksize, chunk_rows=args.chunk_rows, \
+                      stage_log=args.stage_log, encode_ids=args.encode_ids)
+    for path in paths:
+        print(path)
+    print('{:.1f}s'.format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
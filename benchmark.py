@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import clean_data
+import synthetic_data
+
+
+### 性能测试：用模拟数据逐阶段计时、记录内存峰值，结果写成json，便于发现性能回退和估算批处理机器规格
+def count_rows(result):
+    ''' 统计阶段输出的行数，多个输出时逐个统计
+    '''
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    return [len(df) for df in result if isinstance(df, pd.DataFrame)]
+
+def time_stage(records, stage, func, *args, trace_memory=True, **kwargs):
+    ''' 执行一个阶段，记录耗时、内存峰值和输出行数
+    Args:
+        records(list): 记录列表，结果追加到其中
+        stage(string): 阶段名
+        func(function): 阶段函数
+        args, kwargs: 传给func的参数
+        trace_memory(bool): 是否用tracemalloc记录内存峰值，开启后耗时会变长
+    Returns:
+        result: func的返回值
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    record = {'stage': stage,
+              'seconds': time.perf_counter() - wall,
+              'cpu_seconds': time.process_time() - cpu,
+              'rows_out': count_rows(result)}
+    if trace_memory:
+        record['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    records.append(record)
+    return result
+
+def run_benchmark(n_customers, seed=0, trace_memory=True, work_dir=None, chunksize=500000):
+    ''' 生成一套模拟数据，依次测试清洗流程的各阶段
+    Args:
+        n_customers(int): 用户数
+        seed(int): 随机种子
+        trace_memory(bool): 是否记录内存峰值
+        work_dir(string): 模拟数据的写入目录，默认使用临时目录
+        chunksize(int): sep_df_chunked每批读取的记录条数
+    Returns:
+        result(dict): 数据规模和各阶段的记录
+    '''
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = synthetic_data.write_dataset(work_dir or tmp_dir, n_customers, seed=seed)
+        opts = {'trace_memory': trace_memory}
+
+        portfolio = time_stage(records, 'load_portfolio', clean_data.load_portfolio, paths['portfolio'], **opts)
+        profile = time_stage(records, 'load_profile', clean_data.load_profile, paths['profile'], \
+                             chunksize=chunksize, **opts)
+        received, viewed, completed, transaction = time_stage(records, 'sep_df_chunked', \
+            clean_data.sep_df_chunked, paths['transcript'], portfolio, chunksize=chunksize, **opts)
+        received_info = received.query("offer_type == 'informational'")
+        received_other = received.query("offer_type != 'informational'")
+        _, _, transaction_response, _, received_response = time_stage(records, 'clean_response', \
+            clean_data.clean_response, received, viewed, completed, transaction, received_info, received_other, **opts)
+        received_response_cid = pd.merge(received_response, profile, on='cid')
+        transaction_response_cid = pd.merge(transaction_response, profile, on='cid')
+        cid_stats = time_stage(records, 'clean_cid_stats', \
+            clean_data.clean_cid_stats, received_response_cid, transaction_response_cid, **opts)
+        time_stage(records, 'add_feature_cols', clean_data.add_feature_cols, cid_stats, **opts)
+
+        with open(paths['transcript']) as f:
+            n_events = sum(1 for _ in f)
+
+    return {'n_customers': n_customers, 'n_events': n_events, 'seed': seed, 'stages': records}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='用模拟数据测试清洗流程各阶段的耗时和内存峰值')
+    parser.add_argument('--customers', type=int, nargs='+', default=[10000], help='用户数，可给多个规模')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=500000)
+    parser.add_argument('--no-memory', action='store_true', help='不记录内存峰值，耗时更准确')
+    parser.add_argument('--out', default='bench_output.json', help='结果json的输出路径')
+    args = parser.parse_args(argv)
+
+    results = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+               'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'runs': []}
+    for n in args.customers:
+        run = run_benchmark(n, seed=args.seed, trace_memory=not args.no_memory, chunksize=args.chunksize)
+        results['runs'].append(run)
+        for record in run['stages']:
+            print('{:>10} {:<18} {:8.2f}s {}'.format(n, record['stage'], record['seconds'],
+                  '{:8.1f}MB'.format(record['peak_mb']) if 'peak_mb' in record else ''))
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
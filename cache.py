@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+import clean_data
+from clean_data import load_portfolio, load_profile, sep_df_chunked, clean_response
+
+
+### 清洗结果的列式磁盘缓存：按输入文件指纹、清洗代码和参数缓存各阶段的输出，输入和代码不变时直接读取
+# 依赖pyarrow读写parquet
+# 缓存的版本号，缓存的存储方式(write_frame/read_frame)变化时修改
+CACHE_VERSION = 1
+
+
+def code_fingerprint():
+    ''' 计算产生缓存结果的代码指纹：各阶段的清洗函数都在clean_data中，取其源码的sha1，
+        修改清洗逻辑(如归因的取舍规则)后旧的缓存不再命中
+    Returns:
+        fingerprint(string): 缓存版本号和clean_data源码的sha1
+    '''
+    with open(clean_data.__file__, 'rb') as f:
+        return '{}:{}'.format(CACHE_VERSION, hashlib.sha1(f.read()).hexdigest())
+
+def file_fingerprint(path, cache_dir):
+    ''' 计算输入文件的内容指纹，按(路径, 大小, 修改时间)记住已算过的指纹，文件未变时无需重新读取
+    Args:
+        path(string): 输入文件路径
+        cache_dir(string): 缓存目录，指纹记录保存在其中
+    Returns:
+        fingerprint(string): 文件内容的sha1
+    '''
+    stat = os.stat(path)
+    memo_key = '{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    memo_path = os.path.join(cache_dir, 'fingerprints.json')
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+    if memo_key not in memo:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        memo[memo_key] = sha1.hexdigest()
+        # 先写临时文件再替换，共用缓存目录的其他进程不会读到写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.fingerprints-', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp_path, memo_path)
+    return memo[memo_key]
+
+def cache_key(stage, input_paths, params, cache_dir):
+    ''' 缓存键：阶段名、输入文件指纹、代码指纹和函数参数共同决定
+    Args:
+        stage(string): 阶段名
+        input_paths(list): 该阶段依赖的输入文件
+        params(dict): 影响输出的函数参数
+        cache_dir(string): 缓存目录
+    Returns:
+        key(string): 缓存键
+    '''
+    content = {'stage': stage,
+               'inputs': [file_fingerprint(path, cache_dir) for path in input_paths],
+               'code': code_fingerprint(),
+               'params': params or {}}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def write_frame(df, path):
+    ''' 写parquet文件；parquet不支持区间类型的Categorical(pd.cut的输出)，改存编码并把区间写入元数据
+    Args:
+        df(df): 要写入的表
+        path(string): 文件路径
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    intervals = {}
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and isinstance(df[col].cat.categories, pd.IntervalIndex):
+            categories = df[col].cat.categories
+            intervals[col] = {'left': categories.left.tolist(), 'right': categories.right.tolist(),
+                              'closed': categories.closed, 'ordered': bool(df[col].cat.ordered)}
+            df[col] = df[col].cat.codes
+    table = pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'interval_columns'] = json.dumps(intervals).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), path)
+
+def read_frame(path):
+    ''' 读parquet文件，还原区间类型的Categorical
+    Args:
+        path(string): 文件路径
+    Returns:
+        df(df): 读出的表
+    '''
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    intervals = json.loads((table.schema.metadata or {}).get(b'interval_columns', b'{}'))
+    df = table.to_pandas()
+    for col, meta in intervals.items():
+        categories = pd.IntervalIndex.from_arrays(meta['left'], meta['right'], closed=meta['closed'])
+        df[col] = pd.Categorical.from_codes(df[col], categories=categories, ordered=meta['ordered'])
+    return df
+
+
+def load_or_build(stage, build, input_paths, params=None, cache_dir='cache'):
+    ''' 读取某阶段的缓存结果，没有缓存或输入已变化时调用build重新计算并写入缓存
+    Args:
+        stage(string): 阶段名
+        build(function): 无参函数，返回一个表或多个表的tuple
+        input_paths(list): 该阶段依赖的输入文件
+        params(dict): 影响输出的函数参数
+        cache_dir(string): 缓存目录
+    Returns:
+        df(df 或 tuple): 该阶段的输出
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, '{}-{}'.format(stage, cache_key(stage, input_paths, params, cache_dir)))
+    manifest = os.path.join(entry, 'manifest.json')
+
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            meta = json.load(f)
+        frames = tuple(read_frame(os.path.join(entry, name)) for name in meta['files'])
+        return frames if meta['is_tuple'] else frames[0]
+
+    result = build()
+    frames = result if isinstance(result, tuple) else (result,)
+    
+    # 先写入临时目录，写完后整体改名为缓存目录；同一缓存键的多个进程各写各的临时目录，不会交错写入
+    tmp_entry = tempfile.mkdtemp(dir=cache_dir, prefix='.{}-'.format(os.path.basename(entry)))
+    try:
+        names = ['part-{}.parquet'.format(i) for i in range(len(frames))]
+        for df, name in zip(frames, names):
+            write_frame(df, os.path.join(tmp_entry, name))
+        # manifest最后写入，作为缓存完整的标志
+        with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+            json.dump({'files': names, 'is_tuple': isinstance(result, tuple)}, f)
+        
+        # 旧版本中断留下的不完整缓存目录先删除；其他进程已写好完整缓存时保留其结果
+        if os.path.isdir(entry) and not os.path.exists(manifest):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            if not os.path.exists(manifest):
+                raise
+    finally:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    return result
+
+
+def cached_pipeline(portfolio_path, profile_path, transcript_path, cache_dir='cache', chunksize=500000):
+    ''' 带缓存的清洗流程：load_portfolio、load_profile、sep_df、clean_response
+    Args:
+        portfolio_path, profile_path, transcript_path(string): 三个原始数据文件路径
+        cache_dir(string): 缓存目录
+        chunksize(int): 分批读取profile、transcript的记录条数，不影响输出
+    Returns:
+        tables(dict): portfolio、profile、received、viewed、completed、transaction、
+                      received_response、transaction_response
+    '''
+    tables = {}
+    tables['portfolio'] = load_or_build('portfolio', \
+        lambda: load_portfolio(portfolio_path), \
+        [portfolio_path], cache_dir=cache_dir)
+    tables['profile'] = load_or_build('profile', \
+        lambda: load_profile(profile_path, chunksize=chunksize), \
+        [profile_path], cache_dir=cache_dir)
+
+    sep_inputs = [portfolio_path, transcript_path]
+    received, viewed, completed, transaction = load_or_build('sep_df', \
+        lambda: sep_df_chunked(transcript_path, tables['portfolio'], chunksize=chunksize), \
+        sep_inputs, cache_dir=cache_dir)
+    tables.update(received=received, viewed=viewed, completed=completed, transaction=transaction)
+
+    def build_response():
+        received_info = received.query("offer_type == 'informational'")
+        received_other = received.query("offer_type != 'informational'")
+        _, _, transaction_response, _, received_response = \
+            clean_response(received, viewed, completed, transaction, received_info, received_other)
+        return received_response, transaction_response
+    tables['received_response'], tables['transaction_response'] = \
+        load_or_build('clean_response', build_response, sep_inputs, cache_dir=cache_dir)
+
+    return tables
@@ -1,52 +1,189 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 import math
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# 清洗函数都用instrumented装饰，开启instrument.instrument时记录性能数据；逐行apply调用的函数除外
+from instrument import instrumented, reset_worker
 
 ### 基础处理函数
-def clean_portfolio(portfolio):
+# 各表中的id字段及其对应的id字典
+ID_COLUMNS = {'cid':'cid', 'person':'cid',
+              'offerid':'offer', 'offer':'offer', 'received_offer':'offer',
+              'viewed_offer':'offer', 'completed_offer':'offer'}
+
+# 推送渠道
+CHANNELS = ['email', 'mobile', 'web', 'social']
+
+# 用户分段的区间，分段结果为有序的区间Categorical，同pd.cut
+MEMBER_YEAR_BINS = pd.CategoricalDtype(pd.IntervalIndex.from_breaks([2012,2014,2016,2018]), ordered=True)
+AGE_BINS = pd.CategoricalDtype(pd.IntervalIndex.from_breaks([17,35,55,75,100]), ordered=True)
+INCOME_BINS = pd.CategoricalDtype(pd.IntervalIndex.from_breaks([29,45,60,75,90,120]), ordered=True)
+GENDER_DTYPE = pd.CategoricalDtype(['F', 'M', 'O'])
+
+@instrumented
+def cut_bins(values, bins):
+    ''' 按预先建好的区间分段，结果同pd.cut(values, bins=区间端点)
+    Args:
+        values(np.array): 需要分段的数值
+        bins(pd.CategoricalDtype): 右闭区间的Categorical类型，如AGE_BINS
+    Returns:
+        binned(pd.Categorical): 分段结果，不在区间内的值为空
+    '''
+    breaks = np.append(bins.categories.left.values, bins.categories.right.values[-1])
+    values = np.asarray(values, dtype=float)
+    codes = np.searchsorted(breaks, values, side='left') - 1
+    codes[~((values > breaks[0]) & (values <= breaks[-1]))] = -1
+    return pd.Categorical.from_codes(codes, dtype=bins)
+
+@instrumented
+def build_id_dtypes(profile, portfolio):
+    ''' 建立用户和offer的id字典，将32位十六进制id映射为紧凑的整数编码(Categorical)
+    Args:
+        profile(df): 原始用户信息表，需包含全部用户
+        portfolio(df): 原始活动信息表
+    Returns:
+        id_dtypes(dict): {'cid': 用户id字典, 'offer': offer id字典}
+    '''
+    # 字典按id排序，编码后groupby的输出顺序与按字符串分组时一致
+    return {'cid': pd.CategoricalDtype(np.sort(profile['id'].unique())),
+            'offer': pd.CategoricalDtype(np.sort(portfolio['id'].unique()))}
+
+@instrumented
+def encode_ids(df, id_dtypes):
+    ''' 将表中的id字段编码为整数编码，之后的连接和分组都基于编码进行
+    Args:
+        df(df): 含id字段的表
+        id_dtypes(dict): build_id_dtypes的输出
+    Returns:
+        df(df): id字段编码后的表
+    '''
+    encoded = df.astype({col: id_dtypes[key] for col, key in ID_COLUMNS.items() if col in df.columns})
+    
+    # 不在字典中的id会被编码为空值，连接时空值之间会互相匹配，串到无关的用户上，直接报错
+    for col in ID_COLUMNS:
+        if col in df.columns:
+            unknown = encoded[col].isna().values & df[col].notna().values
+            if unknown.any():
+                raise ValueError('{}中有{}个id不在id字典中，如{}；id字典需包含全部用户和offer'\
+                                 .format(col, unknown.sum(), df[col].values[unknown][0]))
+    return encoded
+
+@instrumented
+def decode_ids(df):
+    ''' 将编码后的id字段还原为字符串，用于输出
+    Args:
+        df(df): 含编码id字段的表
+    Returns:
+        df(df): id字段为字符串的表
+    '''
+    return df.astype({col: object for col in ID_COLUMNS if col in df.columns \
+                      and isinstance(df[col].dtype, pd.CategoricalDtype)})
+
+@instrumented
+def clean_portfolio(portfolio, id_dtypes=None):
     ''' 清洗portfolio活动信息
     Args:
         portfolio(df): 原始活动信息表
+        id_dtypes(dict): id字典，传入时offerid编码为整数编码
     Returns:
         portfolio(df): 重命名字段名、扩展字段后的活动信息表
     '''
     portfolio['duration_hour'] = portfolio['duration']*24
     portfolio = portfolio.rename(columns={'id':'offerid', 'duration':'duration_day'})
+    if id_dtypes is not None:
+        portfolio = encode_ids(portfolio, id_dtypes)
     
-    portfolio['email'] = [int('email' in l) for l in portfolio.channels.values]
-    portfolio['mobile'] = [int('mobile' in l) for l in portfolio.channels.values]
-    portfolio['web'] = [int('web' in l) for l in portfolio.channels.values]
-    portfolio['social'] = [int('social' in l) for l in portfolio.channels.values]
+    # 推送渠道一次展开为0/1字段，数据中没有出现的渠道记为0
+    channels = portfolio.channels.str.join(',').str.get_dummies(sep=',')\
+                        .reindex(columns=CHANNELS, fill_value=0).astype(int)
+    portfolio = pd.concat([portfolio, channels], axis=1)
     portfolio = portfolio.drop('channels',axis=1)
     portfolio = portfolio.reset_index()
     return portfolio
 
-def clean_profile(profile): 
+@instrumented
+def clean_profile(profile, id_dtypes=None): 
     ''' 清洗profile用户信息
     Args:
         profile(df): 原始用户信息表
+        id_dtypes(dict): id字典，传入时cid编码为整数编码
     Returns:
         profile(df): 去除年龄异常值、重命名字段名、扩展字段后的用户信息表
     ''' 
     profile = profile.rename(columns={'id':'cid'})
+    if id_dtypes is not None:
+        profile = encode_ids(profile, id_dtypes)
     
     # 有2000多个年龄异常(118岁)，这部分用户没有收入和性别信息，剔除
-    profile = profile.query("age<=100")
-    profile['became_member_month'] = profile['became_member_on'].astype(str).apply(lambda x: x[4:6]).astype(int)
+    profile = profile.query("age<=100").copy()
+    # 注册日期为yyyymmdd格式的整数，年、月用整数运算取出
+    member_on = profile['became_member_on'].values.astype(np.int64)
+    profile['became_member_month'] = member_on // 100 % 100
     
     # 加字段
-    profile['became_member_year'] = profile['became_member_on'].astype(str).apply(lambda x: x[:4]).astype(int)
-    profile['became_member_year'] = pd.cut(profile['became_member_year'], bins=[2012,2014,2016,2018])
-    profile['age_range'] = pd.cut(profile['age'], bins=[17,35,55,75,100])
+    profile['became_member_year'] = cut_bins(member_on // 10000, MEMBER_YEAR_BINS)
+    profile['age_range'] = cut_bins(profile['age'].values, AGE_BINS)
     profile['income'] = profile['income']/1000
-    profile['income_range'] = pd.cut(profile['income'], bins=[29,45,60,75,90,120])
+    profile['income_range'] = cut_bins(profile['income'].values, INCOME_BINS)
     
     return profile
 
+@instrumented
+def load_portfolio(path, id_dtypes=None):
+    ''' 读取portfolio.json并清洗，offer序号字段命名为offeridx
+    Args:
+        path(string): portfolio.json文件路径
+        id_dtypes(dict): id字典，传入时offerid编码为整数编码
+    Returns:
+        portfolio(df): 同clean_portfolio，index字段重命名为offeridx
+    '''
+    return clean_portfolio(pd.read_json(path, lines=True), id_dtypes).rename(columns={'index':'offeridx'})
+
+@instrumented
+def load_id_dtypes(profile_path, portfolio_path, chunksize=500000):
+    ''' 从profile.json、portfolio.json建立id字典，profile只保留id字段，分批读取
+    Args:
+        profile_path, portfolio_path(string): 数据文件路径
+        chunksize(int): 每批读取的记录条数
+    Returns:
+        id_dtypes(dict): 同build_id_dtypes
+    '''
+    profile = pd.concat([chunk[['id']] for chunk in pd.read_json(profile_path, lines=True, chunksize=chunksize)])
+    return build_id_dtypes(profile, pd.read_json(portfolio_path, lines=True))
 
+@instrumented
+def load_profile(path, chunksize=500000, id_dtypes=None):
+    ''' 分批读取profile.json，每批直接转换为紧凑类型的字段后再合并，结果同clean_profile
+    Args:
+        path(string): profile.json文件路径
+        chunksize(int): 每批读取的记录条数
+        id_dtypes(dict): id字典，传入时cid编码为整数编码
+    Returns:
+        profile(df): 字段、取值同clean_profile；性别为Categorical，年龄、注册年月为小整数，收入为float32
+    '''
+    parts = []
+    for chunk in pd.read_json(path, lines=True, chunksize=chunksize):
+        chunk = chunk[chunk['age'].values <= 100]
+        member_on = chunk['became_member_on'].values.astype(np.int64)
+        income = chunk['income'].values / 1000
+        cid = chunk['id'] if id_dtypes is None \
+              else encode_ids(chunk[['id']].rename(columns={'id':'cid'}), id_dtypes)['cid']
+        parts.append(pd.DataFrame({'gender': pd.Categorical(chunk['gender'], dtype=GENDER_DTYPE),
+                                   'age': chunk['age'].values.astype(np.int8),
+                                   'cid': cid,
+                                   'became_member_on': member_on.astype(np.int32),
+                                   'income': income.astype(np.float32),
+                                   'became_member_month': (member_on // 100 % 100).astype(np.int8),
+                                   'became_member_year': cut_bins(member_on // 10000, MEMBER_YEAR_BINS),
+                                   'age_range': cut_bins(chunk['age'].values, AGE_BINS),
+                                   'income_range': cut_bins(income, INCOME_BINS)}, index=chunk.index))
+    return pd.concat(parts)
+
+
+@instrumented
 def draw_hist_pics(df, cols=[], hue='gender'):
     ''' 遍历数据列，画直方图，默认用颜色区分性别
     Args:
@@ -56,9 +193,13 @@ def draw_hist_pics(df, cols=[], hue='gender'):
     Returns:
         无
     '''
+    # 绘图库只在画图时导入，批处理流程不加载
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    
     for i,col in enumerate(df[cols].columns):
         if col != hue:
-            g = sns.FacetGrid(df[cols], size = 3,aspect = 1.5, hue = hue,palette='deep'\
+            g = sns.FacetGrid(df[cols], height = 3,aspect = 1.5, hue = hue,palette='deep'\
                               ,hue_order= sorted(df[hue].unique()))
             g.map(plt.hist,col,alpha=0.6)
             plt.title('Distribution of '+ col)
@@ -67,6 +208,63 @@ def draw_hist_pics(df, cols=[], hue='gender'):
             g.add_legend()
             plt.show();
 
+@instrumented
+def draw_binned_hist(df, cols=[], hue='gender', bins=30, ncols=3, path=None):
+    ''' 大表的直方图：每列按共同的分箱边界一次算出各分类的频数，各分类的均值一次groupby算出，
+        画图只用分箱后的频数，所有列画在一张图里，耗时取决于分箱数而不是行数
+    Args:
+        df(df): 需要画直方图的数据框
+        cols(list): 需要画图的所有列
+        hue(string): 分类变量，默认性别
+        bins(int): 分箱数
+        ncols(int): 每行画几列
+        path(string): 图片保存路径，默认直接显示
+    Returns:
+        fig: 画好的图
+    '''
+    # 绘图库只在画图时导入，批处理流程不加载
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    
+    cols = [col for col in cols if col != hue]
+    levels = sorted(df[hue].dropna().unique())
+    hue_codes = pd.Categorical(df[hue], categories=levels).codes
+    values = df[cols].astype(float).replace([np.inf, -np.inf], np.nan)
+    
+    # 各分类的均值，一次groupby
+    means = values[hue_codes >= 0].groupby(hue_codes[hue_codes >= 0]).mean()
+    
+    nrows = max(1, math.ceil(len(cols) / ncols))
+    fig, axes = plt.subplots(nrows, ncols, figsize=(4.5 * ncols, 3 * nrows), squeeze=False)
+    colors = sns.color_palette('deep', len(levels))
+    for ax, col in zip(axes.flat, cols):
+        col_values = values[col].values
+        valid = ~np.isnan(col_values) & (hue_codes >= 0)
+        edges = np.histogram_bin_edges(col_values[valid], bins=bins)
+        
+        # 分箱规则同np.histogram：左闭右开，最后一箱包含右端点；分类和分箱编码合并后一次计数
+        bin_idx = np.clip(np.searchsorted(edges, col_values[valid], side='right') - 1, 0, len(edges) - 2)
+        counts = np.bincount(hue_codes[valid] * (len(edges) - 1) + bin_idx, \
+                             minlength=len(levels) * (len(edges) - 1)).reshape(len(levels), len(edges) - 1)
+        
+        for i, level in enumerate(levels):
+            ax.stairs(counts[i], edges, fill=True, alpha=0.6, color=colors[i], label=level)
+            if i in means.index and not np.isnan(means.loc[i, col]):
+                ax.axvline(means.loc[i, col], c=colors[i])
+        ax.set_title('Distribution of '+ col)
+    for ax in axes.flat[len(cols):]:
+        ax.set_visible(False)
+    
+    handles, labels = axes.flat[0].get_legend_handles_labels()
+    fig.legend(handles, labels, title=hue, loc='upper right')
+    fig.tight_layout()
+    if path is not None:
+        fig.savefig(path)
+        plt.close(fig)
+    else:
+        plt.show()
+    return fig
+
 
 
 ### 整合表的函数
@@ -85,11 +283,13 @@ def parse_offer(value):
         value = None           
     return  value
 
-def sep_df(transcript,  portfolio):
+@instrumented
+def sep_df(transcript,  portfolio, id_dtypes=None):
     ''' 分离交易记录表里的四类记录数据，包括接收offer、浏览offer、完成offer，以及所有交易金额记录
     Args:
         transcript(json): 交易数据记录
         portfolio(df):所有用户信息，接收记录和交易记录中，只保留有用户信息的用户记录
+        id_dtypes(dict): id字典，传入时cid和offer id编码为整数编码，portfolio需用同一字典编码
     Returns:
         received (df): 用户接收offer记录
         viewed(df): 用户浏览offer记录
@@ -99,6 +299,8 @@ def sep_df(transcript,  portfolio):
     transcript['offer'] = transcript.value.apply(lambda v : parse_offer(v))
 
     transcript['amount'] = transcript.value.apply(lambda x : x['amount'] if 'amount' in x.keys() else np.nan)
+    if id_dtypes is not None:
+        transcript = encode_ids(transcript, id_dtypes)
     
     received = transcript.query("event == 'offer received'")\
                         .rename(columns={'time':'received_time','offer':'received_offer', 'person':'cid'})\
@@ -115,13 +317,25 @@ def sep_df(transcript,  portfolio):
                                 .rename(columns={'time':'transaction_time','person':'cid'})\
                                 .drop(['value','event','offer'],axis=1)
     
-    # 完成offer的记录存在少数重复，做去重处理
     completed = transcript.query("event == 'offer completed'")\
                             .rename(columns={'time':'completed_time','offer':'completed_offer','person':'cid'})\
-                            .drop(['value','event','amount'],axis=1).drop_duplicates()
+                            .drop(['value','event','amount'],axis=1)
     
-    completed = pd.merge(completed,transaction,how='left',left_on=['cid','completed_time'],\
-                         right_on=['cid','transaction_time']).drop(['completed_time'],axis=1)
+    return combine_events(received, viewed, completed, transaction)
+
+
+@instrumented
+def combine_events(received, viewed, completed, transaction):
+    ''' 四类记录分离后的整合处理：完成记录去重并关联交易金额，接收记录和交易记录按用户取交集
+    Args:
+        received (df): 已关联活动信息的接收offer记录
+        viewed(df): 浏览offer记录
+        completed(df): 完成offer记录，含completed_time字段
+        transaction(df): 交易金额记录
+    Returns:
+        received, viewed, completed, transaction: 同sep_df
+    ''' 
+    completed = join_completed(completed, transaction)
     
     #收到offer的用户和交易人数取交集,使计算响应率时基于的用户群一致
     received = received[received.cid.isin(transaction.cid.unique())]
@@ -130,6 +344,91 @@ def sep_df(transcript,  portfolio):
     return received, viewed,  completed, transaction
 
 
+@instrumented
+def join_completed(completed, transaction):
+    ''' 完成offer记录去重，并按用户和完成时间关联对应的交易金额
+    Args:
+        completed(df): 完成offer记录，含completed_time字段
+        transaction(df): 交易金额记录
+    Returns:
+        completed(df): 关联交易后的完成offer记录
+    ''' 
+    # 完成offer的记录存在少数重复，做去重处理
+    completed = completed.drop_duplicates()
+    completed = pd.merge(completed,transaction,how='left',left_on=['cid','completed_time'],\
+                         right_on=['cid','transaction_time']).drop(['completed_time'],axis=1)
+    return completed
+
+
+EVENT_TYPES = ['offer received', 'offer viewed', 'offer completed', 'transaction']
+
+@instrumented
+def parse_transcript_chunk(chunk, id_dtypes=None):
+    ''' 将一批交易数据记录一次性解析为带类型的列，替代逐行apply parse_offer
+    Args:
+        chunk(df): 交易数据记录，含person、event、value、time字段
+        id_dtypes(dict): id字典，传入时cid和offer id编码为整数编码
+    Returns:
+        events(df): 含cid、event(事件类型编码)、time、offer、amount字段的记录
+    ''' 
+    values = pd.DataFrame(chunk['value'].tolist(), index=chunk.index)
+    offer = pd.Series(None, index=chunk.index, dtype=object)
+    # 取值优先级同parse_offer
+    for key in ['offer_id', 'offer id']:
+        if key in values.columns:
+            offer = values[key].where(values[key].notna(), offer)
+    amount = values['amount'].astype(float) if 'amount' in values.columns else np.nan
+    
+    events = pd.DataFrame({'cid': chunk['person'],
+                           'event': pd.Categorical(chunk['event'], categories=EVENT_TYPES).codes,
+                           'time': chunk['time'],
+                           'offer': offer,
+                           'amount': amount}, index=chunk.index)
+    if id_dtypes is not None:
+        events = encode_ids(events, id_dtypes)
+    return events
+
+@instrumented
+def route_events(events):
+    ''' 按事件类型编码把解析后的记录分到四类表中，字段名同sep_df
+    Args:
+        events(df): parse_transcript_chunk的输出
+    Returns:
+        received, viewed, completed, transaction (df): 未关联活动信息的四类记录
+    ''' 
+    received = events.loc[events.event.values == 0, ['cid','time','offer']]\
+                        .rename(columns={'time':'received_time','offer':'received_offer'})
+    viewed = events.loc[events.event.values == 1, ['cid','time','offer']]\
+                        .rename(columns={'time':'viewed_time','offer':'viewed_offer'})
+    completed = events.loc[events.event.values == 2, ['cid','time','offer']]\
+                        .rename(columns={'time':'completed_time','offer':'completed_offer'})
+    transaction = events.loc[events.event.values == 3, ['cid','time','amount']]\
+                        .rename(columns={'time':'transaction_time'})
+    return received, viewed, completed, transaction
+
+@instrumented
+def sep_df_chunked(transcript_path, portfolio, chunksize=500000, id_dtypes=None):
+    ''' 分批流式读取json-lines格式的交易数据记录，分离四类记录，结果同sep_df
+    Args:
+        transcript_path(string): transcript.json文件路径
+        portfolio(df): 清洗后的活动信息
+        chunksize(int): 每批读取的记录条数，决定解析时的内存上限
+        id_dtypes(dict): id字典，传入时cid和offer id编码为整数编码，portfolio需用同一字典编码
+    Returns:
+        received, viewed, completed, transaction (df): 同sep_df
+    ''' 
+    parts = [[], [], [], []]
+    for chunk in pd.read_json(transcript_path, lines=True, chunksize=chunksize):
+        for part, df in zip(parts, route_events(parse_transcript_chunk(chunk, id_dtypes))):
+            part.append(df)
+    received, viewed, completed, transaction = [pd.concat(part) for part in parts]
+    
+    received = pd.merge(received, portfolio, how='left', left_on='received_offer', right_on='offerid')\
+                 .drop(['offerid'], axis=1)
+    
+    return combine_events(received, viewed, completed, transaction)
+
+
 def is_valid_viewed(row):
     ''' 判断是否为有效浏览
     Args:
@@ -162,6 +461,111 @@ def is_valid_comp(row):
         return 0
 
 
+@instrumented
+def calc_valid_viewed(df):
+    ''' 按列批量判断是否为有效浏览，逻辑同is_valid_viewed
+    Args:
+        df (df): 含received_time、viewed_time、duration_hour字段的表
+    Returns:
+        valid (np.array): 每行是否有效浏览，1或0
+    ''' 
+    # NaN参与比较结果为False，没有浏览记录的行判为0，与逐行函数一致
+    view_hour_after_receive = df['viewed_time'].values - df['received_time'].values
+    valid = (view_hour_after_receive <= df['duration_hour'].values) & (view_hour_after_receive >= 0)
+    return valid.astype(int)
+
+@instrumented
+def calc_valid_comp(df):
+    ''' 按列批量判断消费是否受到offer影响，逻辑同is_valid_comp
+    Args:
+        df (df): 含received_time、viewed_time、transaction_time、duration_hour、amount、difficulty字段的表
+    Returns:
+        valid (np.array): 每行是否受offer影响，1或0
+    ''' 
+    trans_hour_after_receive = df['transaction_time'].values - df['received_time'].values
+    valid = (trans_hour_after_receive <= df['duration_hour'].values) & (trans_hour_after_receive >= 0) \
+            & (df['transaction_time'].values >= df['viewed_time'].values) \
+            & (df['amount'].values >= df['difficulty'].values)
+    return valid.astype(int)
+
+
+@instrumented
+def first_per_group(df, keys, by, ascending=True):
+    ''' 每组取排序后的第一行，结果同按by稳定排序、groupby(keys).cumcount()+1后保留序号为1的行
+    Args:
+        df (df): 输入表
+        keys (list): 分组字段，含空值的行不属于任何组，同groupby的默认行为
+        by (string): 排序字段，空值排在最后
+        ascending (bool): True时取最小值，False时取最大值；取值相同时取原表中靠前的行
+    Returns:
+        first (df): 每组的第一行，保持原表的行顺序，索引重置
+    ''' 
+    if len(df) == 0:
+        return df.reset_index(drop=True)
+    
+    # 分组字段编码为整数，空值编码为-1
+    codes = [df[key].cat.codes.values if isinstance(df[key].dtype, pd.CategoricalDtype) \
+             else pd.factorize(df[key])[0] for key in keys]
+    values = df[by].values.astype(float)
+    
+    # lexsort以最后一个数组为主键：按分组，组内按取值、空值排最后，取值相同按行号
+    order = np.lexsort([np.arange(len(df)), values if ascending else -values, np.isnan(values)] + codes[::-1])
+    sorted_codes = [key_codes[order] for key_codes in codes]
+    is_first = np.r_[True, np.any([c[1:] != c[:-1] for c in sorted_codes], axis=0)]
+    is_first &= np.all([c >= 0 for c in sorted_codes], axis=0)
+    
+    return df.iloc[np.sort(order[is_first])].reset_index(drop=True)
+
+@instrumented
+def match_first_transaction(received_view, transaction):
+    ''' 区间连接：为每条有效浏览记录找出第一笔满足is_valid_comp条件的交易，不构造cid维度的笛卡尔积
+    Args:
+        received_view (df): offer有效浏览记录，含cid、received_time、viewed_time、duration_hour、difficulty字段
+        transaction (df): 用户交易记录
+    Returns:
+        received_view_comp (df): 有效浏览记录+对应的第一笔有效交易，字段同merge后按comp_rn==1过滤的结果
+    ''' 
+    tr_cols = [col for col in transaction.columns if col != 'cid']
+    
+    # cid统一编码后，交易按(cid, transaction_time)排序，同时间的交易保留原顺序
+    cid_codes = pd.factorize(pd.concat([received_view['cid'], transaction['cid']], ignore_index=True))[0]
+    left_codes = cid_codes[:len(received_view)]
+    tr_codes = cid_codes[len(received_view):]
+    tr_time = transaction['transaction_time'].values.astype(float)
+    order = np.lexsort((tr_time, tr_codes))
+    
+    # 交易有效窗口：[max(接收时间, 浏览时间), 接收时间+有效期]
+    start = np.maximum(received_view['received_time'].values, received_view['viewed_time'].values).astype(float)
+    end = (received_view['received_time'].values + received_view['duration_hour'].values).astype(float)
+    
+    # 每个用户的时间轴错开一个span，所有用户的交易落在同一个有序数组上，用searchsorted定位窗口
+    all_time = np.concatenate([tr_time, start, end])
+    base = np.nanmin(all_time) if len(all_time) else 0
+    span = np.ceil(np.nanmax(all_time) - base) + 1 if len(all_time) else 1
+    tr_key = tr_codes[order] * span + (tr_time[order] - base)
+    lo = np.searchsorted(tr_key, left_codes * span + (start - base), side='left')
+    hi = np.searchsorted(tr_key, left_codes * span + (end - base), side='right')
+    
+    # 按difficulty分别计算"从位置i起第一笔金额达标的交易"，窗口内存在则取之
+    amount = transaction['amount'].values[order]
+    difficulty = received_view['difficulty'].values
+    n = len(order)
+    first = np.full(len(received_view), n)
+    for d in np.unique(difficulty):
+        idx = np.where(amount >= d, np.arange(n), n)
+        next_ok = np.append(np.minimum.accumulate(idx[::-1])[::-1], n)
+        rows = difficulty == d
+        first[rows] = next_ok[lo[rows]]
+    valid = first < hi
+    
+    received_view_comp = received_view[valid].reset_index(drop=True)
+    matched = transaction.iloc[order[first[valid]]][tr_cols].reset_index(drop=True)
+    received_view_comp = pd.concat([received_view_comp, matched], axis=1)
+    received_view_comp['is_valid_comp'] = 1
+    received_view_comp['comp_rn'] = 1
+    return received_view_comp
+
+@instrumented
 def clean_received_info(received_info, viewed,transaction):
     ''' 清洗信息类offer接收记录
     Args:
@@ -175,31 +579,20 @@ def clean_received_info(received_info, viewed,transaction):
     # 保留满足条件的浏览记录
     received_info_view = pd.merge(received_info,viewed,  how='left', left_on=['cid','received_offer'],\
                 right_on=['cid','viewed_offer']).drop('viewed_offer',axis=1)
-    received_info_view['is_valid_viewed'] = received_info_view .apply(lambda row: is_valid_viewed(row), axis=1)
+    received_info_view['is_valid_viewed'] = calc_valid_viewed(received_info_view)
     received_info_view = received_info_view.query("is_valid_viewed==1")
 
     # 同一个cid、offer和offer接收时间后续有多次浏览的，只将后续最近一次浏览算作对该offer的浏览
-    received_info_view = received_info_view.assign(view_rn = received_info_view\
-                                                            .sort_values(by=['viewed_time'], ascending=True)\
-                                             .groupby(['cid','received_offer','received_time'])\
-                                             .cumcount()+1)
-    received_info_view = received_info_view.query("view_rn==1").reset_index().drop('index',axis=1)
+    received_info_view = first_per_group(received_info_view, ['cid','received_offer','received_time'], \
+                                         'viewed_time').assign(view_rn=1)
     
-    # 保留满足条件的交易记录，根据用户连接
-    received_info_view_comp = pd.merge(received_info_view,transaction,how='left',on='cid')
-    received_info_view_comp['is_valid_comp'] = received_info_view_comp.apply(lambda row: is_valid_comp(row), axis=1)
-    received_info_view_comp = received_info_view_comp.query("is_valid_comp==1")
-
-    # 同一个cid、offer和offer接收时间后续有多次交易的，只将后续最近一次交易算作对该offer的最终响应
-    received_info_view_comp = received_info_view_comp.assign(comp_rn = received_info_view_comp\
-                                             .sort_values(by=['transaction_time'], ascending=True)\
-                                             .groupby(['cid','received_offer','received_time','viewed_time'])\
-                                             .cumcount()+1)
-    received_info_view_comp = received_info_view_comp.query("comp_rn==1").reset_index().drop('index',axis=1)
+    # 按offer有效期做区间连接，取浏览之后第一笔满足条件的交易作为对该offer的最终响应
+    received_info_view_comp = match_first_transaction(received_info_view, transaction)
     
     
     return received_info_view, received_info_view_comp
 
+@instrumented
 def clean_received_other(received_other, viewed,completed):
     ''' 清洗bogo和折扣类offer接收记录
     Args:
@@ -213,35 +606,36 @@ def clean_received_other(received_other, viewed,completed):
     # 保留满足条件的浏览记录
     received_other_view = pd.merge(received_other,viewed,  how='left', left_on=['cid','received_offer'],\
                 right_on=['cid','viewed_offer']).drop('viewed_offer',axis=1)
-    received_other_view['is_valid_viewed'] = received_other_view .apply(lambda row: is_valid_viewed(row), axis=1)
+    received_other_view['is_valid_viewed'] = calc_valid_viewed(received_other_view)
 
     # 同一个cid、offer和offer接收时间后续有多次浏览的，只将后续最近一次浏览算作对该offer的浏览
     received_other_view = received_other_view.query("is_valid_viewed==1")
-    received_other_view = received_other_view.assign(view_rn = received_other_view\
-                                                            .sort_values(by=['viewed_time'], ascending=True)\
-                                             .groupby(['cid','received_offer','received_time'])\
-                                             .cumcount()+1)
-    received_other_view = received_other_view.query("view_rn==1").reset_index().drop('index',axis=1)
+    received_other_view = first_per_group(received_other_view, ['cid','received_offer','received_time'], \
+                                          'viewed_time').assign(view_rn=1)
     
     
     # 保留满足条件的交易记录，根据用户和completed_offer连接
     received_other_view_comp = pd.merge(received_other_view,completed, how='left', left_on=['cid','received_offer'],\
                             right_on=['cid','completed_offer']).drop('completed_offer',axis=1)
-    received_other_view_comp['is_valid_comp'] = received_other_view_comp.apply(lambda row: is_valid_comp(row), axis=1)
+    received_other_view_comp['is_valid_comp'] = calc_valid_comp(received_other_view_comp)
     received_other_view_comp = received_other_view_comp.query("is_valid_comp==1")
     
     # 同一个cid、offer和offer接收时间后续有多次交易的，只将后续最近一次交易算作对该offer的最终响应
-    received_other_view_comp = received_other_view_comp.assign(comp_rn = received_other_view_comp\
-                                         .sort_values(by=['transaction_time'], ascending=True)\
-                                         .groupby(['cid','received_offer','received_time','viewed_time'])\
-                                         .cumcount()+1)
-    received_other_view_comp = received_other_view_comp.query("comp_rn==1").reset_index()\
-                                                        .drop(['index'],axis=1)
+    received_other_view_comp = first_per_group(received_other_view_comp, \
+                                               ['cid','received_offer','received_time','viewed_time'], \
+                                               'transaction_time').assign(comp_rn=1)
     
     
     return received_other_view, received_other_view_comp
 
 
+# 交易-offer响应联合表中保留的offer响应字段
+RESPONSE_COLUMNS = ['cid','received_time','received_offer','reward',\
+                    'viewed_time','transaction_time','amount','is_valid_comp',\
+                    'offeridx','difficulty','duration_day','offer_type','duration_hour',\
+                    'email','mobile','web','social']
+
+@instrumented
 def clean_response(received,viewed,completed,transaction,received_info,received_other):
     ''' 综合之前的清洗逻辑，输出offer是否真正被响应的标识
     Args:
@@ -265,26 +659,34 @@ def clean_response(received,viewed,completed,transaction,received_info,received_
     received_view = pd.concat([received_other_view, received_info_view], ignore_index=True)
     received_view_comp = pd.concat([received_other_view_comp,received_info_view_comp], ignore_index=True)
     
-    # offer响应记录和交易记录结合
-    response1 = received_view_comp[['cid','received_time','received_offer','reward',\
-                               'viewed_time','transaction_time','amount','is_valid_comp',\
-                            'offeridx','difficulty','duration_day','offer_type','duration_hour',\
-                                    'email','mobile','web','social']]
+    # offer响应记录和交易记录结合，活动字段被裁剪时(pipeline.py)只取存在的字段
+    response1 = received_view_comp[[col for col in RESPONSE_COLUMNS if col in received_view_comp.columns]]
     transaction_response = pd.merge(transaction,response1,how='left',on=['cid','transaction_time','amount'])
     
     # 发现存在一个交易同时受到多种offer影响的情况
     # 比如cid==f1bcf3081d46456696400dce6ca36e11，在transaction_time=504的时候，满足三种offer条件
-    transaction_response = transaction_response.assign(reward_rn = transaction_response\
-                                         .sort_values(by=['reward'], ascending=False)\
-                                         .groupby(['cid','transaction_time','amount'])\
-                                         .cumcount()+1) 
-    
     # 假设业务逻辑是一次只能使用一种优惠，这里选择reward最高的作为交易响应的offer
-    transaction_response = transaction_response.query("reward_rn==1").reset_index().drop('index',axis=1)
+    transaction_response = first_per_group(transaction_response, ['cid','transaction_time','amount'], \
+                                           'reward', ascending=False)
     transaction_response['is_offer'] = transaction_response.is_valid_comp.fillna(0).astype(int)
-    transaction_response = transaction_response.drop(['is_valid_comp','reward_rn'],axis=1)
+    transaction_response = transaction_response.drop(['is_valid_comp'],axis=1)
+    
     
+    response, received_response = match_response(received, transaction_response)
     
+    return received_view, received_view_comp, transaction_response, response, received_response
+
+
+@instrumented
+def match_response(received, transaction_response):
+    ''' 从交易-offer响应联合表中取出offer纯响应记录，并和接收offer的记录结合
+    Args:
+        received (df): 所有offer接收记录
+        transaction_response (df): 交易-offer响应联合表
+    Returns:
+        response (df) :  offer纯响应记录表
+        received_response (df) : 接收-offer响应联合表
+    ''' 
     # 最终offer响应记录，以及和接收offer的记录结合
     response = transaction_response[['cid','received_time','received_offer',\
                                'viewed_time','transaction_time','amount','is_offer']]\
@@ -294,12 +696,106 @@ def clean_response(received,viewed,completed,transaction,received_info,received_
                                  how='left',on=['cid','received_time','received_offer'])
     
     received_response['is_response'] = received_response.is_response.fillna(0).astype(int)
+    
+    return response, received_response
 
+
+@instrumented
+def clean_response_shard(tables):
+    ''' 单个用户分片上的响应归因，供进程池调用
+    Args:
+        tables (tuple): 该分片的(viewed, completed, transaction, received_info, received_other)
+    Returns:
+        received_view, received_view_comp, transaction_response (df): 同clean_response
+    ''' 
+    viewed, completed, transaction, received_info, received_other = tables
+    received = pd.concat([received_other, received_info])
+    received_view, received_view_comp, transaction_response, _, _ = \
+        clean_response(received, viewed, completed, transaction, received_info, received_other)
+    return received_view, received_view_comp, transaction_response
+
+@instrumented
+def clean_response_sharded(received,viewed,completed,transaction,received_info,received_other,\
+                           n_workers=None, shard_size=None):
+    ''' 按用户哈希分片，用进程池并行执行clean_response，结果与串行执行完全一致
+    Args:
+        received, viewed, completed, transaction, received_info, received_other (df): 同clean_response
+        n_workers (int): 进程数，默认为CPU核数，为1时在当前进程内逐片执行
+        shard_size (int): 每个分片的用户数，默认按进程数平均分片
+    Returns:
+        received_view, received_view_comp, transaction_response, response, received_response (df): 同clean_response
+    ''' 
+    n_workers = n_workers or os.cpu_count() or 1
+    n_cids = pd.concat([received_other.cid, received_info.cid, transaction.cid]).nunique()
+    n_shards = max(1, math.ceil(n_cids / shard_size) if shard_size else n_workers)
+    
+    # 记录原始行号，合并各分片结果后按行号稳定排序，还原串行执行时的行顺序
+    received_other = received_other.assign(_rn_received=np.arange(len(received_other)))
+    received_info = received_info.assign(_rn_received=len(received_other) + np.arange(len(received_info)))
+    transaction = transaction.assign(_rn_transaction=np.arange(len(transaction)))
+    
+    tables = [viewed, completed, transaction, received_info, received_other]
+    shard_ids = [pd.util.hash_pandas_object(df.cid, index=False).values % n_shards for df in tables]
+    shards = [tuple(df[ids == i] for df, ids in zip(tables, shard_ids)) for i in range(n_shards)]
+    shards = [shard for shard in shards if len(shard[3]) + len(shard[4]) > 0]
+    
+    if n_workers == 1:
+        results = [clean_response_shard(shard) for shard in shards]
+    else:
+        # 子进程中关闭性能记录，只在主进程记录clean_response_sharded的整体耗时
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=reset_worker) as executor:
+            results = list(executor.map(clean_response_shard, shards))
+    
+    outputs = []
+    for parts, rn_col in zip(zip(*results), ['_rn_received', '_rn_received', '_rn_transaction']):
+        df = pd.concat(parts).sort_values(by=rn_col, kind='mergesort').reset_index(drop=True)
+        outputs.append(df.drop([col for col in ['_rn_received', '_rn_transaction'] if col in df.columns], axis=1))
+    received_view, received_view_comp, transaction_response = outputs
+    
+    response, received_response = match_response(received, transaction_response)
     
     return received_view, received_view_comp, transaction_response, response, received_response
 
 
 
+@instrumented
+def group_stats(codes, columns, prefix):
+    ''' 按用户编码分段归约(reduceat)，一次计算多个字段的统计值
+    Args:
+        codes (np.array): 每行的用户编码，已排序
+        columns (dict): {字段名: (取值数组, [聚合函数])}，聚合函数为count、sum、amin、amax、mean
+        prefix (string): 统计前缀，同clean_cid_stats
+    Returns:
+        stats (df): 按用户编码索引的统计表，字段名为 字段名+前缀+聚合函数
+    ''' 
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=int)
+    
+    stats = {}
+    for col, (values, funcs) in columns.items():
+        values = np.asarray(values)
+        isnull = pd.isna(values)
+        count = np.add.reduceat((~isnull).astype(np.int64), starts) if len(codes) else np.array([], dtype=np.int64)
+        # 有空值时按pandas的规则忽略空值：和为0，最小、最大值为NaN
+        if isnull.any():
+            values = values.astype(float)
+            low, high, values = np.where(isnull, np.inf, values), np.where(isnull, -np.inf, values), \
+                                np.where(isnull, 0, values)
+        else:
+            low = high = values
+        reduce = lambda ufunc, arr: ufunc.reduceat(arr, starts) if len(codes) else arr[:0]
+        result = {'count': lambda: count,
+                  'sum': lambda: reduce(np.add, values),
+                  'amin': lambda: np.where(count > 0, reduce(np.minimum, low), np.nan) if isnull.any() \
+                                  else reduce(np.minimum, low),
+                  'amax': lambda: np.where(count > 0, reduce(np.maximum, high), np.nan) if isnull.any() \
+                                  else reduce(np.maximum, high),
+                  'mean': lambda: reduce(np.add, values) / np.where(count > 0, count, np.nan)}
+        for func in funcs:
+            stats[col + prefix + func] = result[func]()
+    
+    return pd.DataFrame(stats, index=codes[starts])
+
+@instrumented
 def clean_cid_stats(received_response_cid, transaction_response_cid):
     ''' 统计每个用户的offer和交易相关指标数据
     Args:
@@ -308,44 +804,59 @@ def clean_cid_stats(received_response_cid, transaction_response_cid):
     Returns:
         cid_stats (df):  输出用户统计表
     ''' 
-    received_response_cid1 = received_response_cid.join(pd.get_dummies(received_response_cid['offer_type']))
-    
-    cid_group1 = received_response_cid1.groupby("cid")
-    cid_group2 = received_response_cid1.query("is_response==1").groupby("cid")
-    cid_group3 = transaction_response_cid.groupby(["cid"])
+    # 两张表的cid统一编码一次，之后都按编码分段归约
+    codes, cids = pd.factorize(pd.concat([received_response_cid['cid'], transaction_response_cid['cid']],\
+                                         ignore_index=True), sort=True)
+    received_order = np.argsort(codes[:len(received_response_cid)], kind='stable')
+    transaction_order = np.argsort(codes[len(received_response_cid):], kind='stable')
+    received_codes = codes[:len(received_response_cid)][received_order]
+    transaction_codes = codes[len(received_response_cid):][transaction_order]
+    received_col = lambda col: received_response_cid[col].values[received_order]
+    transaction_col = lambda col: transaction_response_cid[col].values[transaction_order]
+    
+    # offer类型按编码计数，不生成哑变量表
+    type_codes, offer_types = pd.factorize(received_col('offer_type'))
+    type_index = {t: i for i, t in enumerate(offer_types)}
+    # 数据中没有出现的类型编码记为-2，计数为0
+    types = {t: (type_codes == type_index.get(t, -2)).astype(np.int64) for t in ['bogo','discount','informational']}
+    social = received_col('social')
+    difficulty = received_col('difficulty')
     
     # 用户接收offer的统计
-    cid_stats1 =  cid_group1.agg({'received_time':'count',
-                'bogo':np.sum,
-                'discount':np.sum,
-                'informational':np.sum,
-                'social':np.sum,
-                'difficulty':[np.min,np.max,np.mean]
-                 })
-    cid_stats1.columns = ['_rece_'.join(col).strip() for col in cid_stats1.columns.values]
+    cid_stats1 = group_stats(received_codes, {
+                'received_time': (received_col('received_time'), ['count']),
+                'bogo': (types['bogo'], ['sum']),
+                'discount': (types['discount'], ['sum']),
+                'informational': (types['informational'], ['sum']),
+                'social': (social, ['sum']),
+                'difficulty': (difficulty, ['amin','amax','mean'])
+                 }, '_rece_')
     
     # 用户响应offer的统计
-    cid_stats2 = cid_group2.agg({'bogo':np.sum,
-                    'discount':np.sum,
-                    'informational':np.sum,
-                    'social':np.sum,
-                    'difficulty':[np.min,np.max,np.mean],
-                    'amount':[np.min, np.max,np.mean,np.sum]
-                     })
-
-    cid_stats2.columns = ['_offer_'.join(col).strip() for col in cid_stats2.columns.values]
+    resp = received_col('is_response') == 1
+    cid_stats2 = group_stats(received_codes[resp], {
+                    'bogo': (types['bogo'][resp], ['sum']),
+                    'discount': (types['discount'][resp], ['sum']),
+                    'informational': (types['informational'][resp], ['sum']),
+                    'social': (social[resp], ['sum']),
+                    'difficulty': (difficulty[resp], ['amin','amax','mean']),
+                    'amount': (received_col('amount')[resp], ['amin','amax','mean','sum'])
+                     }, '_offer_')
     
     #用户交易的统计，包括响应offer的交易统计
-    cid_stats3 = cid_group3.agg({'amount':[np.min, np.max,np.mean,np.sum],
-                               'transaction_time':'count',
-                               'is_offer':'sum',
-                            })
-    cid_stats3.columns = ['_tr_'.join(col).strip() for col in cid_stats3.columns.values]
+    cid_stats3 = group_stats(transaction_codes, {
+                    'amount': (transaction_col('amount'), ['amin','amax','mean','sum']),
+                    'transaction_time': (transaction_col('transaction_time'), ['count']),
+                    'is_offer': (transaction_col('is_offer'), ['sum'])
+                     }, '_tr_')
     
-    cid_stats = cid_stats3.join(cid_stats2).join(cid_stats1).reset_index()
-    return cid_stats
+    cid_stats = cid_stats3.join(cid_stats2).join(cid_stats1).sort_index()
+    cid_stats.index = cids.take(cid_stats.index)
+    cid_stats.index.name = 'cid'
+    return cid_stats.reset_index()
 
 
+@instrumented
 def calc_ratio(df, col1, col2, new_ratio_col):
     ''' 比例指标计算
     Args:
@@ -359,6 +870,7 @@ def calc_ratio(df, col1, col2, new_ratio_col):
     df[new_ratio_col] = df[col1]/df[col2]
     return df
 
+@instrumented
 def add_feature_cols(cid_with_offer):
     ''' 用户统计表，增加几个比例指标
     Args:
@@ -413,6 +925,7 @@ def add_feature_cols(cid_with_offer):
 
 
 ### 查看用户群特征
+@instrumented
 def find_cid_groups(df, feature_groups, metric, condition='==1'):
     ''' 查看用户分组
     Args:
@@ -423,6 +936,7 @@ def find_cid_groups(df, feature_groups, metric, condition='==1'):
     Returns:
        col_like (df): 特定活动offer条件下的原始用户分组数据
        col_like_cid_groups (df): 特定活动offer条件下的,排序靠前的用户分组数据
+       marginals (dict): 各用户特征字段的分组人数，{字段名: 人数(series)}
     ''' 
     col_like = df.query("{0}{1}".format(metric,condition)).groupby(feature_groups)\
                         .agg({metric:['count'],
@@ -432,13 +946,27 @@ def find_cid_groups(df, feature_groups, metric, condition='==1'):
     
     col_like.columns = ['count','tr_amount_mean','tr_count_mean']
     
-    col_like_cid_groups = col_like.sort_values(by=['count','tr_count_mean','tr_amount_mean'],ascending=False)\
-                                    .reset_index().head(10)
-    
-    print(col_like.groupby('gender')['count'].sum(), "\n",\
-            col_like.groupby('age_range')['count'].sum(), "\n",\
-            col_like.groupby('income_range')['count'].sum(), "\n",\
-            col_like.groupby('became_member_year')['count'].sum(),"\n",\
-         )
-    
-    return col_like,col_like_cid_groups
+    return col_like, top_cid_groups(col_like), cid_group_marginals(col_like, feature_groups)
+
+@instrumented
+def top_cid_groups(col_like, n=10):
+    ''' 按人数、平均交易次数、平均交易金额排序，取靠前的用户分组
+    Args:
+        col_like (df): find_cid_groups输出的用户分组数据
+        n (int): 取前几组
+    Returns:
+        col_like_cid_groups (df): 排序靠前的用户分组数据
+    ''' 
+    return col_like.sort_values(by=['count','tr_count_mean','tr_amount_mean'],ascending=False)\
+                   .reset_index().head(n)
+
+@instrumented
+def cid_group_marginals(col_like, feature_groups):
+    ''' 用户分组数据按每个用户特征字段汇总人数，如按性别、年龄段、收入段、注册年份
+    Args:
+        col_like (df): find_cid_groups输出的用户分组数据
+        feature_groups (list): 用户特征字段list
+    Returns:
+        marginals (dict): {字段名: 人数(series)}
+    ''' 
+    return {col: col_like.groupby(col)['count'].sum() for col in feature_groups}
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+from clean_data import top_cid_groups, cid_group_marginals
+
+
+### 用户群特征的预聚合立方体：按用户特征分组和指标取值预先计算人数和求和，
+### 之后任意指标条件下的用户分组、排序靠前的分组和各特征的分组人数都从立方体汇总，不再扫描用户统计表
+### 立方体按指标的精确取值分组，任意条件的结果都与find_cid_groups一致；只有取值较少的指标才能压缩
+# 用户特征维度，clean_profile的输出字段
+DIMENSIONS = ['gender', 'age_range', 'income_range', 'became_member_year']
+# find_cid_groups中求平均的字段
+MEASURES = ['amount_tr_mean', 'transaction_time_tr_count']
+# add_feature_cols输出的次数之比，取值只有几十种，立方体的格子数远小于用户数，默认预聚合的指标
+RATIO_COLUMNS = ['offer_count_ratio', 'bogo_offer_ratio', 'discount_offer_ratio',
+                 'informational_offer_ratio', 'social_offer_ratio']
+# add_feature_cols输出的金额、最低消费之比，取值连续，几乎每个用户一个取值，按取值分组后格子数接近用户数，
+# 查询并不比find_cid_groups快，默认不预聚合；可通过metrics参数指定，结果仍然精确
+CONTINUOUS_COLUMNS = ['offer_amount_ratio', 'difficulty_offer_ratio']
+
+
+def build_cube(df, metrics=None, dimensions=DIMENSIONS):
+    ''' 预聚合：每个指标按(各维度取值, 指标取值)分组，计算人数、指标非空数、各平均字段的和与非空数
+    Args:
+        df(df): 用户特征表，用户统计表+用户信息，同find_cid_groups的输入
+        metrics(list): 需要预聚合的指标，默认为df中RATIO_COLUMNS的字段；CONTINUOUS_COLUMNS中的字段可以指定，
+                       但格子数接近用户数，起不到压缩作用
+        dimensions(list): 用户特征维度
+    Returns:
+        cube(dict): 维度的取值和类型、各指标的预聚合表
+    '''
+    metrics = [col for col in RATIO_COLUMNS if col in df.columns] if metrics is None else metrics
+    cube = {'dimensions': list(dimensions), 'levels': {}, 'dtypes': {}, 'metrics': {}}
+
+    # 维度编码为整数，空值为-1；Categorical维度保留全部类别，同groupby(observed=False)
+    codes = {}
+    for dim in dimensions:
+        if isinstance(df[dim].dtype, pd.CategoricalDtype):
+            codes[dim] = df[dim].cat.codes.values
+            cube['levels'][dim] = df[dim].cat.categories
+        else:
+            codes[dim], cube['levels'][dim] = pd.factorize(df[dim], sort=True)
+        cube['dtypes'][dim] = df[dim].dtype
+
+    measures = {}
+    for col in MEASURES:
+        values = df[col].values.astype(float)
+        measures[col + '_sum'] = np.where(np.isnan(values), 0, values)
+        measures[col + '_count'] = (~np.isnan(values)).astype(np.int64)
+
+    for metric in metrics:
+        values = df[metric].values.astype(float)
+        frame = pd.DataFrame(dict(codes, value=values, metric_count=(~np.isnan(values)).astype(np.int64),
+                                  **measures))
+        cube['metrics'][metric] = frame.groupby(list(dimensions) + ['value'], dropna=False, sort=False)\
+                                       .sum().reset_index()
+    return cube
+
+def query_cube(cube, metric, condition='==1', feature_groups=None, n=10):
+    ''' 从立方体查询特定指标条件下的用户分组，结果同find_cid_groups
+    Args:
+        cube(dict): build_cube的输出
+        metric(string): 要限制的活动offer相关字段，须已预聚合
+        condition(string): 要限制的指标条件，同find_cid_groups
+        feature_groups(list): 用户特征字段list，须为立方体维度的子集，默认为全部维度
+        n(int): 排序靠前的分组数
+    Returns:
+        col_like (df): 特定活动offer条件下的原始用户分组数据
+        col_like_cid_groups (df): 特定活动offer条件下的,排序靠前的用户分组数据
+        marginals (dict): 各用户特征字段的分组人数
+    '''
+    if metric not in cube['metrics']:
+        raise ValueError('指标{}未预聚合，可选：{}；连续取值的指标可直接用find_cid_groups查询'\
+                         .format(metric, list(cube['metrics'])))
+    feature_groups = cube['dimensions'] if feature_groups is None else list(feature_groups)
+
+    # 条件只在指标的取值上计算一次
+    cells = cube['metrics'][metric]
+    selected = cells[pd.DataFrame({metric: cells['value'].values}).eval(metric + condition).values]
+
+    # 各维度的分组取值：Categorical维度为全部类别，其他维度为条件下出现过的取值，同groupby；
+    # 有Categorical维度时输出各维度取值的全部组合，否则只输出出现过的组合
+    indexes, positions = [], []
+    for dim in feature_groups:
+        dim_codes = selected[dim].values
+        levels = cube['levels'][dim]
+        if isinstance(cube['dtypes'][dim], pd.CategoricalDtype):
+            present = np.arange(len(levels))
+            indexes.append(pd.CategoricalIndex(levels, dtype=cube['dtypes'][dim], name=dim))
+        else:
+            present = np.unique(dim_codes[dim_codes >= 0])
+            indexes.append(pd.Index(levels[present], name=dim))
+        positions.append(np.where(dim_codes >= 0, np.searchsorted(present, dim_codes), -1))
+
+    # 按分组汇总，含空值维度的行不属于任何分组
+    shape = [len(index) for index in indexes]
+    valid = np.all([pos >= 0 for pos in positions], axis=0) if len(selected) else np.zeros(0, dtype=bool)
+    flat = np.ravel_multi_index([pos[valid] for pos in positions], shape) if shape else np.zeros(0, dtype=int)
+    size = int(np.prod(shape))
+    total = lambda col: np.bincount(flat, weights=selected[col].values[valid], minlength=size)
+    mean = lambda col: total(col + '_sum') / np.where(total(col + '_count') > 0, total(col + '_count'), np.nan)
+
+    index = indexes[0] if len(indexes) == 1 else pd.MultiIndex.from_product(indexes)
+    col_like = pd.DataFrame({'count': total('metric_count').astype(np.int64),
+                             'tr_amount_mean': mean('amount_tr_mean'),
+                             'tr_count_mean': mean('transaction_time_tr_count')}, index=index)
+    if not any(isinstance(cube['dtypes'][dim], pd.CategoricalDtype) for dim in feature_groups):
+        col_like = col_like[np.bincount(flat, minlength=size) > 0]
+
+    return col_like, top_cid_groups(col_like, n), cid_group_marginals(col_like, feature_groups)
@@ -0,0 +1,233 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from clean_data import parse_transcript_chunk, route_events, join_completed, clean_response, \
+                       match_response, add_feature_cols
+
+
+### 增量更新：每天只处理新增的交易记录，更新仍在有效期内的offer响应和受影响用户的统计数据
+# 用户统计的聚合规则，同clean_cid_stats：{统计前缀: {源字段: [聚合函数]}}
+STAT_SPECS = {
+    '_tr_': {'amount':['amin','amax','mean','sum'],
+             'transaction_time':['count'],
+             'is_offer':['sum']},
+    '_offer_': {'bogo':['sum'], 'discount':['sum'], 'informational':['sum'], 'social':['sum'],
+                'difficulty':['amin','amax','mean'],
+                'amount':['amin','amax','mean','sum']},
+    '_rece_': {'received_time':['count'],
+               'bogo':['sum'], 'discount':['sum'], 'informational':['sum'], 'social':['sum'],
+               'difficulty':['amin','amax','mean']},
+}
+
+# 与clean_cid_stats的输出类型一致
+STAT_DTYPES = {'transaction_time_tr_count':'int64', 'is_offer_tr_sum':'int64',
+               'received_time_rece_count':'int64', 'bogo_rece_sum':'int64', 'discount_rece_sum':'int64',
+               'informational_rece_sum':'int64', 'social_rece_sum':'int64',
+               'difficulty_rece_amin':'int64', 'difficulty_rece_amax':'int64'}
+
+OFFER_TYPES = ['bogo', 'discount', 'informational']
+
+
+def init_state():
+    ''' 初始化增量更新的状态
+    Returns:
+        state(dict): 空状态，依次传给update更新
+    '''
+    return {'seq': 0,                           # 已处理的交易数据记录条数，用于还原全量计算时的行顺序
+            'watermark': None,                  # 已处理记录的最大时间
+            'received': None,                   # 尚未过期的offer接收记录
+            'viewed': None,                     # 仍可能影响未过期offer的浏览、完成、交易记录
+            'completed': None,
+            'transaction': None,
+            'frozen_received_response': None,   # 已过期、不再变化的接收-offer响应记录
+            'active_received_response': None,   # 未过期offer的接收-offer响应记录
+            'transaction_response': None,       # 交易-offer响应记录，交易的归因在交易发生时即确定
+            'stats': {prefix: None for prefix in STAT_SPECS}}   # 用户统计的部分聚合
+
+def save_state(state, path):
+    ''' 持久化增量更新的状态
+    Args:
+        state(dict): 增量更新的状态
+        path(string): 保存路径
+    '''
+    with open(path, 'wb') as f:
+        pickle.dump(state, f)
+
+def load_state(path):
+    ''' 读取持久化的增量更新状态
+    Args:
+        path(string): 保存路径
+    Returns:
+        state(dict): 增量更新的状态
+    '''
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def append_rows(old, new):
+    ''' 状态表追加记录，任一方为空时直接返回另一方，避免空表改变字段类型
+    '''
+    if old is None or (len(old) == 0 and len(new) > 0):
+        return new
+    return old if len(new) == 0 else pd.concat([old, new])
+
+def aggregate_partial(df, prefix):
+    ''' 一批记录按用户计算部分聚合：和、最小值、最大值、非空计数，可与已有的部分聚合合并
+    Args:
+        df(df): 含cid和统计字段的记录
+        prefix(string): 统计前缀，见STAT_SPECS
+    Returns:
+        partial(df): 按cid索引的部分聚合
+    '''
+    cols = list(STAT_SPECS[prefix])
+    grouped = df[['cid'] + cols].groupby('cid')
+    partial = pd.concat({'psum': grouped.sum(), 'pmin': grouped.min(),
+                         'pmax': grouped.max(), 'pcount': grouped.count()}, axis=1)
+    partial.columns = [col + prefix + part for part, col in partial.columns]
+    return partial
+
+def merge_partial(partial, delta):
+    ''' 把新增记录的部分聚合合并到已有的部分聚合中，只更新受影响用户的行
+    Args:
+        partial(df): 已有的部分聚合
+        delta(df): 新增记录的部分聚合
+    Returns:
+        partial(df): 合并后的部分聚合
+    '''
+    if partial is None:
+        return delta
+    rules = {col: {'psum':'sum', 'pmin':'min', 'pmax':'max', 'pcount':'sum'}[col.rsplit('_', 1)[1]] \
+             for col in delta.columns}
+    affected = pd.concat([partial[partial.index.isin(delta.index)], delta]).groupby(level=0).agg(rules)
+    return pd.concat([partial[~partial.index.isin(delta.index)], affected])
+
+def add_offer_dummies(df):
+    ''' 增加offer类型的0/1字段，同clean_cid_stats中按offer类型计数
+    '''
+    return df.assign(**{t: (df['offer_type'] == t).astype(int) for t in OFFER_TYPES})
+
+def finish_cid_stats(stats, cids):
+    ''' 由部分聚合计算用户统计表，字段名、字段顺序同clean_cid_stats
+    Args:
+        stats(dict): 各统计前缀的部分聚合
+        cids(array): 需要输出的用户
+    Returns:
+        cid_stats(df): 用户统计表
+    '''
+    cid_stats = pd.DataFrame(index=pd.Index(np.sort(cids), name='cid'))
+    for prefix, spec in STAT_SPECS.items():
+        partial = stats[prefix].reindex(cid_stats.index) if stats[prefix] is not None \
+                  else pd.DataFrame(index=cid_stats.index)
+        for col, funcs in spec.items():
+            get = lambda part: partial.get(col + prefix + part, pd.Series(np.nan, index=cid_stats.index))
+            values = {'amin': get('pmin'), 'amax': get('pmax'), 'sum': get('psum'),
+                      'count': get('pcount'), 'mean': get('psum') / get('pcount')}
+            for func in funcs:
+                cid_stats[col + prefix + func] = values[func]
+    cid_stats = cid_stats.astype(STAT_DTYPES)
+    return cid_stats.reset_index()
+
+
+def finish_outputs(state, profile):
+    ''' 由增量更新的状态计算全量输出
+    Args:
+        state(dict): 增量更新的状态
+        profile(df): 清洗后的用户信息，只统计其中的用户
+    Returns:
+        received_response, transaction_response, cid_stats (df): 同update，尚未处理过任何记录时都为None
+    '''
+    if state['active_received_response'] is None:
+        return None, None, None
+
+    # 输出：接收offer的用户和交易用户取交集，同sep_df
+    tr_all = state['transaction_response']
+    received_response = append_rows(state['frozen_received_response'], state['active_received_response'])\
+                            .sort_values(by='_seq_received', kind='mergesort')
+    received_cids = received_response.cid.unique()
+    transaction_cids = tr_all.cid.unique()
+    received_response = received_response[received_response.cid.isin(transaction_cids)]\
+                            .drop('_seq_received', axis=1).reset_index(drop=True)
+    transaction_response = tr_all[tr_all.cid.isin(received_cids)]\
+                            .drop('_seq_transaction', axis=1).reset_index(drop=True)
+
+    cids = np.intersect1d(np.intersect1d(received_cids, transaction_cids), profile.cid.unique())
+    cid_stats = add_feature_cols(finish_cid_stats(state['stats'], cids))
+    return received_response, transaction_response, cid_stats
+
+
+def update(state, transcript, portfolio, profile):
+    ''' 用新增的一批交易数据记录更新响应归因和用户统计，结果等同于对全部历史记录重新计算
+    Args:
+        state(dict): 增量更新的状态，init_state或上次update的输出
+        transcript(df): 新增的交易数据记录，时间须晚于已处理的所有记录
+        portfolio(df): 清洗后的活动信息
+        profile(df): 清洗后的用户信息，只统计其中的用户
+    Returns:
+        state(dict): 更新后的状态
+        received_response (df): 全量的接收-offer响应联合表，同clean_response；尚未处理过任何记录时为None
+        transaction_response (df): 全量的交易-offer响应联合表，同clean_response
+        cid_stats (df): 全量的用户统计表，同clean_cid_stats + add_feature_cols
+    '''
+    # 没有新增记录时状态不变；不能用空批次的时间(NaN)覆盖watermark，否则之后的时间检查全部失效
+    if len(transcript) == 0:
+        return (state,) + finish_outputs(state, profile)
+
+    state = dict(state, stats=dict(state['stats']))
+    t0 = transcript['time'].min()
+    if state['watermark'] is not None and t0 <= state['watermark']:
+        raise ValueError('新增记录的时间须晚于已处理记录的最大时间{}'.format(state['watermark']))
+
+    # 解析新增记录，记录行号，用于还原全量计算时的行顺序
+    seq_start = state['seq']
+    events = parse_transcript_chunk(transcript.set_axis(seq_start + np.arange(len(transcript))))
+    received, viewed, completed, transaction = route_events(events)
+    received = pd.merge(received.assign(_seq_received=received.index), portfolio, how='left', \
+                        left_on='received_offer', right_on='offerid').drop(['offerid'], axis=1)
+    transaction = transaction.assign(_seq_transaction=transaction.index)
+    state['seq'] = seq_start + len(transcript)
+    state['watermark'] = transcript['time'].max()
+
+    # 有效期在新增记录之前结束的offer不会再变化，冻结其响应记录
+    old_rr = state['active_received_response']
+    if state['received'] is not None:
+        is_open = state['received'].received_time + state['received'].duration_hour >= t0
+        open_seq = state['received'].loc[is_open, '_seq_received']
+        state['frozen_received_response'] = append_rows(state['frozen_received_response'], \
+                                                        old_rr[~old_rr._seq_received.isin(open_seq)])
+        state['received'] = state['received'][is_open]
+
+    # 只保留可能落在未过期offer有效期内的记录
+    state['received'] = append_rows(state['received'], received)
+    horizon = min(state['received'].received_time.min(), t0) if len(state['received']) else t0
+    for name, time_col, df in [('viewed', 'viewed_time', viewed), ('completed', 'completed_time', completed), \
+                               ('transaction', 'transaction_time', transaction)]:
+        df = append_rows(state[name], df)
+        state[name] = df[df[time_col] >= horizon]
+
+    # 在未过期offer及其有效期内的记录上重新归因，只有新增交易的归因结果是新的
+    received_act = state['received']
+    received_info = received_act.query("offer_type == 'informational'")
+    received_other = received_act.query("offer_type != 'informational'")
+    _, _, transaction_response, _, _ = clean_response(received_act, state['viewed'], \
+                                                     join_completed(state['completed'], state['transaction']), \
+                                                     state['transaction'], received_info, received_other)
+    tr_new = transaction_response[transaction_response._seq_transaction >= seq_start]
+    state['transaction_response'] = append_rows(state['transaction_response'], tr_new)
+
+    # 未过期offer的响应可能来自之前或新增的交易
+    tr_all = state['transaction_response']
+    _, active_rr = match_response(received_act, tr_all[tr_all.received_time >= horizon])
+    state['active_received_response'] = active_rr
+
+    # 更新受影响用户的部分聚合：新接收的offer、新响应的offer、新增的交易
+    responded = active_rr.is_response == 1
+    if old_rr is not None:
+        responded &= ~active_rr._seq_received.isin(old_rr.loc[old_rr.is_response == 1, '_seq_received'])
+    for prefix, df in [('_rece_', add_offer_dummies(received)), ('_offer_', add_offer_dummies(active_rr[responded])), \
+                       ('_tr_', tr_new)]:
+        if len(df):
+            state['stats'][prefix] = merge_partial(state['stats'][prefix], aggregate_partial(df, prefix))
+
+    return (state,) + finish_outputs(state, profile)
@@ -0,0 +1,144 @@
+import contextlib
+import functools
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+### 清洗函数的逐阶段性能记录：默认关闭，开启时记录每次调用的耗时、CPU时间、输入输出行数、连接膨胀倍数和内存峰值
+# 当前的记录器，None表示关闭；关闭时被装饰的函数只多一次判断
+ACTIVE = None
+
+
+def count_frame_rows(obj):
+    ''' 统计参数或返回值中表的行数，多个表时逐个统计
+    Returns:
+        rows(list): 每个表的行数
+    '''
+    if isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray)):
+        return [len(obj)]
+    if isinstance(obj, (tuple, list)):
+        return [n for item in obj for n in count_frame_rows(item)]
+    return []
+
+def instrumented(func):
+    ''' 装饰器：开启记录时，记录函数每次调用的性能数据
+    Args:
+        func(function): 被记录的函数
+    Returns:
+        wrapper(function): 记录关闭时直接调用func
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if ACTIVE is None:
+            return func(*args, **kwargs)
+        return ACTIVE.call(func, args, kwargs)
+    return wrapper
+
+def reset_worker():
+    ''' 进程池的初始化函数：fork出的子进程会继承记录器和正在运行的tracemalloc，子进程的记录不会传回主进程，
+        在子进程中关闭记录，避免白白付出记录和内存跟踪的开销
+    '''
+    global ACTIVE
+    ACTIVE = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+class StageRecorder:
+    ''' 记录器：按调用顺序保存每次调用的记录，嵌套调用时记录层级和上级调用
+    '''
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = []
+        self.stack = []     # 正在执行的调用：(记录, 截至目前的内存峰值)
+
+    def fold_peak(self):
+        ''' 把tracemalloc当前的峰值并入所有正在执行的调用，再重置峰值，使内层调用只统计自身的峰值
+        '''
+        peak = tracemalloc.get_traced_memory()[1]
+        self.stack = [(record, max(frame_peak, peak)) for record, frame_peak in self.stack]
+        tracemalloc.reset_peak()
+
+    def call(self, func, args, kwargs):
+        rows_in = count_frame_rows(list(args) + list(kwargs.values()))
+        record = {'stage': func.__name__,
+                  'depth': len(self.stack),
+                  'parent': self.stack[-1][0]['call_id'] if self.stack else None,
+                  'call_id': len(self.records),
+                  'rows_in': rows_in}
+        self.records.append(record)
+
+        if self.trace_memory:
+            self.fold_peak()
+            record['memory_start_mb'] = tracemalloc.get_traced_memory()[0] / 2**20
+        self.stack.append((record, 0))
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            record['seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            if self.trace_memory:
+                self.fold_peak()
+            _, peak = self.stack.pop()
+            if self.trace_memory:
+                # 内层调用的峰值同时也是外层调用的峰值
+                self.stack = [(parent, max(frame_peak, peak)) for parent, frame_peak in self.stack]
+                record['peak_delta_mb'] = peak / 2**20 - record['memory_start_mb']
+
+        rows_out = count_frame_rows(result)
+        record['rows_out'] = rows_out
+        # 连接膨胀倍数：最大输出表行数 / 最大输入表行数
+        record['blowup'] = max(rows_out) / max(rows_in) if rows_in and rows_out and max(rows_in) else None
+        return result
+
+
+@contextlib.contextmanager
+def instrument(log_path=None, trace_memory=True):
+    ''' 开启性能记录，with语句内调用的clean_data函数都会被记录
+    Args:
+        log_path(string): json-lines日志路径，退出时每次调用追加一行，默认不写日志
+        trace_memory(bool): 是否用tracemalloc记录内存峰值，开启后耗时会变长
+    Returns:
+        records(list): 每次调用的记录，with语句结束后填充完整，可传给summarize汇总
+    '''
+    global ACTIVE
+    previous = ACTIVE
+    recorder = StageRecorder(trace_memory=trace_memory)
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    ACTIVE = recorder
+    try:
+        yield recorder.records
+    finally:
+        ACTIVE = previous
+        if started:
+            tracemalloc.stop()
+        if log_path is not None:
+            with open(log_path, 'a') as f:
+                for record in recorder.records:
+                    f.write(json.dumps(record) + '\n')
+
+def summarize(records):
+    ''' 按函数汇总调用记录
+    Args:
+        records(list): instrument输出的调用记录
+    Returns:
+        report(df): 每个函数的调用次数、总耗时、扣除内层调用后的自身耗时、总CPU时间、最大内存峰值、最大膨胀倍数，
+                    按总耗时降序
+    '''
+    df = pd.DataFrame(records)
+    if len(df) == 0:
+        return df
+    children = df.groupby('parent')['seconds'].sum()
+    df['self_seconds'] = df['seconds'] - df['call_id'].map(children).fillna(0)
+    agg = {'calls': ('call_id', 'count'), 'seconds': ('seconds', 'sum'), 'self_seconds': ('self_seconds', 'sum'),
+           'cpu_seconds': ('cpu_seconds', 'sum'), 'max_blowup': ('blowup', 'max')}
+    if 'peak_delta_mb' in df.columns:
+        agg['max_peak_delta_mb'] = ('peak_delta_mb', 'max')
+    return df.groupby('stage').agg(**agg).sort_values(by='seconds', ascending=False)
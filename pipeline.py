@@ -0,0 +1,184 @@
+import pandas as pd
+
+from clean_data import load_id_dtypes, decode_ids, load_portfolio, load_profile, parse_transcript_chunk, \
+                       route_events, combine_events, clean_response, clean_cid_stats, add_feature_cols, \
+                       find_cid_groups
+
+
+### 惰性执行的清洗流程：先声明需要的输出和字段，执行时只计算用到的阶段，裁剪用不到的字段，
+### 活动信息在接收记录过滤之后再连接，减少大表连接时携带的数据量
+# 各输出所在的阶段
+OUTPUT_STAGES = {'portfolio': 'portfolio', 'profile': 'profile',
+                 'received': 'events', 'viewed': 'events', 'completed': 'events', 'transaction': 'events',
+                 'received_response': 'response', 'transaction_response': 'response',
+                 'cid_stats': 'cid_stats', 'cid_features': 'cid_features', 'cid_groups': 'cid_groups'}
+
+# 各阶段依赖的上游阶段
+STAGE_INPUTS = {'portfolio': [], 'profile': [],
+                'events': ['portfolio'],
+                'response': ['events'],
+                'cid_stats': ['response', 'profile'],
+                'cid_features': ['cid_stats'],
+                'cid_groups': ['cid_features', 'profile']}
+
+# 响应归因用到的活动字段：区分offer类型、有效期、最低消费、同一交易多个offer时按reward取舍
+ATTRIBUTION_COLUMNS = ['offer_type', 'duration_hour', 'difficulty', 'reward']
+# clean_cid_stats用到的字段
+RECEIVED_STATS_COLUMNS = ['cid', 'received_time', 'offer_type', 'social', 'difficulty', 'is_response', 'amount']
+TRANSACTION_STATS_COLUMNS = ['cid', 'amount', 'transaction_time', 'is_offer']
+# find_cid_groups用到的用户统计字段，另加分组字段和指标字段
+GROUP_STATS_COLUMNS = ['amount_tr_mean', 'transaction_time_tr_count']
+
+
+class LazyPipeline:
+    ''' 惰性执行的清洗流程：clean_portfolio → sep_df → clean_response → clean_cid_stats → add_feature_cols
+        → find_cid_groups，select声明输出，collect时才读取数据并计算
+    '''
+    def __init__(self, portfolio_path, profile_path, transcript_path, chunksize=500000, encode_ids=False):
+        '''
+        Args:
+            portfolio_path, profile_path, transcript_path(string): 三个原始数据文件路径
+            chunksize(int): 分批读取profile、transcript的记录条数
+            encode_ids(bool): 是否用id字典把cid和offer id编码为整数编码，内部连接和分组基于编码，输出时还原为字符串；
+                              transcript中的用户须都在profile中，否则报错
+        '''
+        self.paths = {'portfolio': portfolio_path, 'profile': profile_path, 'transcript': transcript_path}
+        self.chunksize = chunksize
+        self.encode_ids = encode_ids
+        self.outputs = {}           # {输出名: 字段list，None表示全部字段}
+        self.group_query = None     # find_cid_groups的参数
+
+    def select(self, output, columns=None):
+        ''' 声明需要的输出
+        Args:
+            output(string): 输出名，见OUTPUT_STAGES
+            columns(list): 需要的字段，默认全部字段
+        Returns:
+            self: 可链式调用
+        '''
+        if output not in OUTPUT_STAGES:
+            raise ValueError('未知的输出{}，可选：{}'.format(output, list(OUTPUT_STAGES)))
+        if output == 'cid_groups' and self.group_query is None:
+            raise ValueError('cid_groups需先调用cid_groups设置分组参数')
+        self.outputs[output] = None if columns is None else list(columns)
+        return self
+
+    def cid_groups(self, feature_groups, metric, condition='==1'):
+        ''' 声明需要find_cid_groups的输出，参数同find_cid_groups
+        Returns:
+            self: 可链式调用
+        '''
+        self.group_query = {'feature_groups': list(feature_groups), 'metric': metric, 'condition': condition}
+        return self.select('cid_groups')
+
+    def stages(self):
+        ''' 需要执行的阶段，按执行顺序
+        '''
+        needed = set()
+        pending = [OUTPUT_STAGES[output] for output in self.outputs]
+        while pending:
+            stage = pending.pop()
+            if stage not in needed:
+                needed.add(stage)
+                pending.extend(STAGE_INPUTS[stage])
+        return [stage for stage in STAGE_INPUTS if stage in needed]
+
+    def portfolio_columns(self, available):
+        ''' 接收记录需要连接的活动字段：归因和统计用到的字段，加上输出中请求的活动字段
+        Args:
+            available(list): 清洗后活动信息的全部字段(不含offerid)
+        Returns:
+            columns(list): 需要连接的字段，保持活动信息表中的字段顺序
+        '''
+        stages = self.stages()
+        needed = set()
+        if 'response' in stages:
+            needed.update(ATTRIBUTION_COLUMNS)
+        if 'cid_stats' in stages:
+            needed.update(RECEIVED_STATS_COLUMNS)
+        for output in ['received', 'received_response', 'transaction_response']:
+            if output in self.outputs:
+                needed.update(available if self.outputs[output] is None else self.outputs[output])
+        return [col for col in available if col in needed]
+
+    def explain(self):
+        ''' 执行计划：要执行的阶段、接收记录连接的活动字段、各输出的字段
+        Returns:
+            plan(dict)
+        '''
+        portfolio = load_portfolio(self.paths['portfolio'])
+        available = [col for col in portfolio.columns if col != 'offerid']
+        return {'stages': self.stages(), 'portfolio_columns': self.portfolio_columns(available),
+                'outputs': dict(self.outputs)}
+
+    def collect(self):
+        ''' 执行计划，计算声明的输出
+        Returns:
+            results(dict): {输出名: 表}，cid_groups为find_cid_groups的(col_like, col_like_cid_groups, marginals)
+        '''
+        stages = self.stages()
+        tables = {}
+
+        id_dtypes = None
+        if self.encode_ids:
+            id_dtypes = load_id_dtypes(self.paths['profile'], self.paths['portfolio'], chunksize=self.chunksize)
+
+        portfolio = load_portfolio(self.paths['portfolio'], id_dtypes=id_dtypes)
+        tables['portfolio'] = portfolio
+        if 'profile' in stages:
+            tables['profile'] = load_profile(self.paths['profile'], chunksize=self.chunksize, id_dtypes=id_dtypes)
+
+        if 'events' in stages:
+            parts = [[], [], [], []]
+            for chunk in pd.read_json(self.paths['transcript'], lines=True, chunksize=self.chunksize):
+                for part, df in zip(parts, route_events(parse_transcript_chunk(chunk, id_dtypes))):
+                    part.append(df)
+            received, viewed, completed, transaction = [pd.concat(part) for part in parts]
+            # 行索引同sep_df_chunked中先连接活动信息再过滤的结果
+            received, viewed, completed, transaction = \
+                combine_events(received.reset_index(drop=True), viewed, completed, transaction)
+
+            # 接收记录按用户过滤后，只连接需要的活动字段
+            columns = self.portfolio_columns([col for col in portfolio.columns if col != 'offerid'])
+            received = pd.merge(received, portfolio[['offerid'] + columns], how='left', \
+                                left_on='received_offer', right_on='offerid')\
+                         .drop(['offerid'], axis=1).set_axis(received.index)
+            tables.update(received=received, viewed=viewed, completed=completed, transaction=transaction)
+
+        if 'response' in stages:
+            received_info = received.query("offer_type == 'informational'")
+            received_other = received.query("offer_type != 'informational'")
+            _, _, transaction_response, _, received_response = \
+                clean_response(received, viewed, completed, transaction, received_info, received_other)
+            tables.update(received_response=received_response, transaction_response=transaction_response)
+
+        if 'cid_stats' in stages:
+            # 只统计有用户信息的用户，同与profile连接后统计，不携带用户信息字段
+            profile_cids = tables['profile'].cid
+            received_response_cid = received_response.loc[received_response.cid.isin(profile_cids), \
+                                                           RECEIVED_STATS_COLUMNS]
+            transaction_response_cid = transaction_response.loc[transaction_response.cid.isin(profile_cids), \
+                                                                 TRANSACTION_STATS_COLUMNS]
+            tables['cid_stats'] = clean_cid_stats(received_response_cid, transaction_response_cid)
+
+        if 'cid_features' in stages:
+            # add_feature_cols直接在输入表上增加字段
+            tables['cid_features'] = add_feature_cols(tables['cid_stats'].copy())
+
+        if 'cid_groups' in stages:
+            query = self.group_query
+            profile_cols = ['cid'] + [col for col in query['feature_groups'] if col in tables['profile'].columns]
+            stats_cols = ['cid'] + [col for col in dict.fromkeys([query['metric']] + GROUP_STATS_COLUMNS + \
+                                    query['feature_groups']) if col in tables['cid_features'].columns]
+            cid_profile = pd.merge(tables['cid_features'][stats_cols], tables['profile'][profile_cols], on='cid')
+            tables['cid_groups'] = find_cid_groups(cid_profile, **query)
+
+        results = {}
+        for output, columns in self.outputs.items():
+            df = tables[output]
+            if output != 'cid_groups':
+                df = df if columns is None else df[columns]
+                # 编码后的id还原为字符串
+                df = df if id_dtypes is None else decode_ids(df)
+            results[output] = df
+        return results
@@ -0,0 +1,164 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from clean_data import match_first_transaction
+
+
+### 模拟星巴克数据：按给定用户数和随机种子生成portfolio、profile、transcript，用于性能测试
+# 活动参数同data/portfolio.json：(offer_type, difficulty, reward, duration, channels)
+OFFER_PARAMS = [('bogo', 10, 10, 7, ['email', 'mobile', 'social']),
+                ('bogo', 10, 10, 5, ['web', 'email', 'mobile', 'social']),
+                ('informational', 0, 0, 4, ['web', 'email', 'mobile']),
+                ('bogo', 5, 5, 7, ['web', 'email', 'mobile']),
+                ('discount', 20, 5, 10, ['web', 'email']),
+                ('discount', 7, 3, 7, ['web', 'email', 'mobile', 'social']),
+                ('discount', 10, 2, 10, ['web', 'email', 'mobile', 'social']),
+                ('informational', 0, 0, 3, ['email', 'mobile', 'social']),
+                ('bogo', 5, 5, 5, ['web', 'email', 'mobile', 'social']),
+                ('discount', 10, 2, 7, ['web', 'email', 'mobile'])]
+
+# 推送时间(小时)，同transcript.json中offer received的时间点
+WAVE_HOURS = [0, 168, 336, 408, 504, 576]
+TEST_HOURS = 714
+
+
+def random_ids(rng, n):
+    ''' 生成n个32位十六进制id
+    '''
+    raw = rng.bytes(16 * n)
+    return np.array([raw[i:i + 16].hex() for i in range(0, 16 * n, 16)], dtype=object)
+
+def generate_portfolio(rng):
+    ''' 生成活动信息表，参数同data/portfolio.json，id随机
+    Args:
+        rng(np.random.Generator): 随机数生成器
+    Returns:
+        portfolio(df): 原始格式的活动信息表
+    '''
+    portfolio = pd.DataFrame(OFFER_PARAMS, columns=['offer_type', 'difficulty', 'reward', 'duration', 'channels'])
+    portfolio['id'] = random_ids(rng, len(portfolio))
+    return portfolio[['reward', 'channels', 'difficulty', 'duration', 'offer_type', 'id']]
+
+def generate_profile(rng, n_customers):
+    ''' 生成用户信息表，约12.8%的用户年龄为118且没有性别和收入，同data/profile.json
+    Args:
+        rng(np.random.Generator): 随机数生成器
+        n_customers(int): 用户数
+    Returns:
+        profile(df): 原始格式的用户信息表
+    '''
+    missing = rng.random(n_customers) < 0.128
+    member_on = pd.Timestamp('2013-07-29') + pd.to_timedelta(rng.integers(0, 1825, n_customers), unit='D')
+    profile = pd.DataFrame({
+        'gender': np.where(missing, None, rng.choice(['M', 'F', 'O'], n_customers, p=[0.57, 0.41, 0.02])),
+        'age': np.where(missing, 118, np.clip(rng.normal(54, 17, n_customers), 18, 101).astype(int)),
+        'id': random_ids(rng, n_customers),
+        'became_member_on': member_on.strftime('%Y%m%d').astype(int),
+        'income': np.where(missing, np.nan, np.round(rng.uniform(30, 120, n_customers)) * 1000)})
+    return profile
+
+def generate_transcript(rng, profile, portfolio, offers_per_wave=0.75, view_rate=0.75, \
+                        transactions_per_customer=8.4, duplicate_rate=0.01):
+    ''' 生成交易数据记录：每轮推送的接收、浏览，按泊松分布生成的交易，满足条件时的完成记录
+    Args:
+        rng(np.random.Generator): 随机数生成器
+        profile(df): 用户信息表
+        portfolio(df): 活动信息表
+        offers_per_wave(float): 每轮推送中用户收到offer的概率
+        view_rate(float): 收到的offer被浏览的概率
+        transactions_per_customer(float): 每个用户的平均交易次数
+        duplicate_rate(float): 完成记录重复的比例
+    Returns:
+        transcript(df): 原始格式的交易数据记录，按时间排序
+    '''
+    cids = profile['id'].values
+    n = len(cids)
+
+    # 接收：每轮推送按概率给部分用户发一个随机offer
+    waves = np.repeat(WAVE_HOURS, n)
+    wave_cids = np.tile(np.arange(n), len(WAVE_HOURS))
+    sent = rng.random(len(waves)) < offers_per_wave
+    received = pd.DataFrame({'cid': cids[wave_cids[sent]], 'received_time': waves[sent],
+                             'offer': rng.integers(0, len(portfolio), sent.sum())})
+    received['duration_hour'] = portfolio['duration'].values[received['offer']] * 24
+    received['difficulty'] = portfolio['difficulty'].values[received['offer']]
+
+    # 浏览：有效期内的随机时间，少数在有效期之后
+    view = rng.random(len(received)) < view_rate
+    viewed = received[view]
+    viewed_time = viewed['received_time'] + (rng.random(len(viewed)) * viewed['duration_hour'] * 1.2).astype(int)
+
+    # 交易：每个用户的交易次数服从泊松分布，时间为6小时的整数倍
+    n_trans = rng.poisson(transactions_per_customer, n)
+    transaction = pd.DataFrame({'cid': np.repeat(cids, n_trans),
+                                'transaction_time': rng.integers(0, TEST_HOURS // 6 + 1, n_trans.sum()) * 6,
+                                'amount': np.round(rng.lognormal(2.3, 0.9, n_trans.sum()), 2)})
+    transaction = transaction.drop_duplicates(['cid', 'transaction_time'])
+
+    # 完成：bogo和折扣offer有效期内第一笔金额达标的交易，同一笔交易可以完成多个offer
+    other = received[portfolio['offer_type'].values[received['offer']] != 'informational']
+    completed = match_first_transaction(other.assign(viewed_time=other['received_time']), transaction)
+    duplicated = completed[rng.random(len(completed)) < duplicate_rate]
+    completed = pd.concat([completed, duplicated])
+
+    offer_ids = portfolio['id'].values
+    rewards = portfolio['reward'].values
+    events = pd.concat([
+        pd.DataFrame({'person': received['cid'], 'event': 'offer received',
+                      'value': [{'offer id': o} for o in offer_ids[received['offer']]],
+                      'time': received['received_time']}),
+        pd.DataFrame({'person': viewed['cid'], 'event': 'offer viewed',
+                      'value': [{'offer id': o} for o in offer_ids[viewed['offer']]],
+                      'time': viewed_time}),
+        pd.DataFrame({'person': transaction['cid'], 'event': 'transaction',
+                      'value': [{'amount': float(a)} for a in transaction['amount']],
+                      'time': transaction['transaction_time']}),
+        pd.DataFrame({'person': completed['cid'], 'event': 'offer completed',
+                      'value': [{'offer_id': offer_ids[o], 'reward': int(rewards[o])} for o in completed['offer']],
+                      'time': completed['transaction_time']})], ignore_index=True)
+    events = events[events['time'] <= TEST_HOURS]
+    return events.sort_values(by='time', kind='mergesort').reset_index(drop=True)
+
+def generate(n_customers, seed=0, **kwargs):
+    ''' 在内存中生成一套模拟数据
+    Args:
+        n_customers(int): 用户数
+        seed(int): 随机种子，相同种子生成相同数据
+        kwargs: 传给generate_transcript的事件比例参数
+    Returns:
+        portfolio, profile, transcript (df): 原始格式的三张表
+    '''
+    rng = np.random.default_rng(seed)
+    portfolio = generate_portfolio(rng)
+    profile = generate_profile(rng, n_customers)
+    transcript = generate_transcript(rng, profile, portfolio, **kwargs)
+    return portfolio, profile, transcript
+
+def write_dataset(out_dir, n_customers, seed=0, block_size=100000, **kwargs):
+    ''' 生成模拟数据并写成json-lines文件，按用户分块生成，内存只取决于block_size
+    Args:
+        out_dir(string): 输出目录，写入portfolio.json、profile.json、transcript.json
+        n_customers(int): 用户数
+        seed(int): 随机种子
+        block_size(int): 每块的用户数
+        kwargs: 传给generate_transcript的事件比例参数
+    Returns:
+        paths(dict): 三个文件的路径
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {name: os.path.join(out_dir, name + '.json') for name in ['portfolio', 'profile', 'transcript']}
+    rng = np.random.default_rng(seed)
+    portfolio = generate_portfolio(rng)
+    portfolio.to_json(paths['portfolio'], orient='records', lines=True)
+
+    # transcript按块内时间排序，块之间按用户分开
+    with open(paths['profile'], 'w') as profile_file, open(paths['transcript'], 'w') as transcript_file:
+        for start in range(0, n_customers, block_size):
+            profile = generate_profile(rng, min(block_size, n_customers - start))
+            transcript = generate_transcript(rng, profile, portfolio, **kwargs)
+            for f, df in [(profile_file, profile), (transcript_file, transcript)]:
+                lines = df.to_json(orient='records', lines=True)
+                f.write(lines if lines.endswith('\n') else lines + '\n')
+    return paths
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# 模块都在仓库根目录下，测试直接导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clean_data import clean_portfolio, clean_profile, sep_df
+from synthetic_data import generate
+
+
+@pytest.fixture(scope='session')
+def raw_data():
+    ''' 模拟数据的原始三张表：portfolio, profile, transcript
+    '''
+    return generate(500, seed=7)
+
+@pytest.fixture(scope='session')
+def tables(raw_data):
+    ''' 清洗并分离后的表：portfolio、profile、received、viewed、completed、transaction、received_info、received_other
+    '''
+    portfolio, profile, transcript = raw_data
+    portfolio = clean_portfolio(portfolio.copy())
+    received, viewed, completed, transaction = sep_df(transcript.copy(), portfolio)
+    return {'portfolio': portfolio, 'profile': clean_profile(profile.copy()),
+            'received': received, 'viewed': viewed, 'completed': completed, 'transaction': transaction,
+            'received_info': received.query("offer_type == 'informational'"),
+            'received_other': received.query("offer_type != 'informational'")}
@@ -0,0 +1,79 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import cache
+from synthetic_data import write_dataset
+
+
+### 缓存：再次运行时读取缓存，结果不变；代码指纹变化时重新计算
+def entries(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if name != 'fingerprints.json')
+
+def test_cached_pipeline_reads_cache(tmp_path):
+    paths = write_dataset(str(tmp_path / 'data'), 200, seed=3)
+    cache_dir = str(tmp_path / 'cache')
+    args = (paths['portfolio'], paths['profile'], paths['transcript'])
+    built = cache.cached_pipeline(*args, cache_dir=cache_dir)
+    cached = cache.cached_pipeline(*args, cache_dir=cache_dir)
+    assert len(entries(cache_dir)) == 4
+    for name, df in built.items():
+        pd.testing.assert_frame_equal(cached[name].reset_index(drop=True), df.reset_index(drop=True))
+
+def test_cache_key_includes_code(tmp_path, monkeypatch):
+    paths = write_dataset(str(tmp_path / 'data'), 50, seed=3)
+    cache_dir = str(tmp_path / 'cache')
+    args = (paths['portfolio'], paths['profile'], paths['transcript'])
+    cache.cached_pipeline(*args, cache_dir=cache_dir)
+    old_entries = entries(cache_dir)
+
+    # 清洗代码变化后，相同输入的缓存键不同，各阶段重新计算
+    monkeypatch.setattr(cache, 'code_fingerprint', lambda: 'changed')
+    cache.cached_pipeline(*args, cache_dir=cache_dir)
+    assert len(entries(cache_dir)) == 2 * len(old_entries)
+    assert set(old_entries) < set(entries(cache_dir))
+
+
+### 并发：多个进程共用缓存目录、同时写同一缓存键时都能成功，不留下临时文件
+def build_frame():
+    return pd.DataFrame({'x': range(1000)})
+
+def load_in_worker(args):
+    input_path, cache_dir = args
+    return len(cache.load_or_build('stage', build_frame, [input_path], cache_dir=cache_dir))
+
+def test_concurrent_builders(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    inputs = []
+    for i in range(8):
+        inputs.append(str(tmp_path / 'input-{}.txt'.format(i)))
+        with open(inputs[-1], 'w') as f:
+            f.write(str(i))
+    # 每个输入文件两个进程同时构建，指纹记录也被多个进程同时更新
+    with ProcessPoolExecutor(max_workers=8) as executor:
+        lengths = list(executor.map(load_in_worker, [(path, cache_dir) for path in inputs * 4]))
+    assert lengths == [1000] * 32
+    assert len(entries(cache_dir)) == 8
+    assert not [name for name in os.listdir(cache_dir) if name.startswith('.')]
+    for name in entries(cache_dir):
+        assert os.path.exists(os.path.join(cache_dir, name, 'manifest.json'))
+
+def test_incomplete_entry_is_rebuilt(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    input_path = str(tmp_path / 'input.txt')
+    with open(input_path, 'w') as f:
+        f.write('x')
+    # 中断的写入留下没有manifest的缓存目录
+    os.makedirs(cache_dir)
+    entry = os.path.join(cache_dir, 'stage-' + cache.cache_key('stage', [input_path], None, cache_dir))
+    os.makedirs(entry)
+    with open(os.path.join(entry, 'part-0.parquet'), 'w') as f:
+        f.write('partial')
+    pd.testing.assert_frame_equal(cache.load_or_build('stage', build_frame, [input_path], cache_dir=cache_dir), \
+                                  build_frame())
+    pd.testing.assert_frame_equal(cache.load_or_build('stage', None, [input_path], cache_dir=cache_dir), \
+                                  build_frame())
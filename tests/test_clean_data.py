@@ -0,0 +1,319 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+import pytest
+
+from clean_data import is_valid_viewed, is_valid_comp, calc_valid_viewed, calc_valid_comp, \
+                       match_first_transaction, clean_received_info, clean_received_other, \
+                       build_id_dtypes, encode_ids, decode_ids, clean_portfolio, sep_df, \
+                       clean_response, clean_response_sharded, sep_df_chunked, clean_cid_stats, \
+                       first_per_group, clean_profile, load_profile, load_portfolio
+
+
+### calc_valid_viewed / calc_valid_comp：与逐行函数结果一致，含连接不到浏览、交易记录的空值行和边界取值
+def valid_frame():
+    ''' 构造判断有效浏览、有效交易的表：随机取值 + 边界取值 + 空值
+    '''
+    rng = np.random.default_rng(0)
+    n = 2000
+    df = pd.DataFrame({'received_time': rng.choice([0, 168, 336, 504], n).astype(float),
+                       'duration_hour': rng.choice([72, 96, 168, 240], n),
+                       'difficulty': rng.choice([0, 5, 7, 10, 20], n)})
+    df['viewed_time'] = df['received_time'] + rng.integers(-48, 260, n)
+    df['transaction_time'] = df['received_time'] + rng.integers(-48, 260, n)
+    df['amount'] = np.round(rng.uniform(0, 30, n), 2)
+
+    # 边界：浏览、交易恰好在有效期最后一刻或接收当时，交易与浏览同时，金额恰好等于最低消费
+    rows = np.arange(0, n, 10)
+    df.loc[rows, 'viewed_time'] = df.loc[rows, 'received_time'] + df.loc[rows, 'duration_hour']
+    df.loc[rows + 1, 'viewed_time'] = df.loc[rows + 1, 'received_time']
+    df.loc[rows + 2, 'transaction_time'] = df.loc[rows + 2, 'received_time'] + df.loc[rows + 2, 'duration_hour']
+    df.loc[rows + 3, 'transaction_time'] = df.loc[rows + 3, 'received_time']
+    df.loc[rows + 4, 'transaction_time'] = df.loc[rows + 4, 'viewed_time']
+    df.loc[rows + 5, 'amount'] = df.loc[rows + 5, 'difficulty']
+
+    # 空值：连接不到浏览记录、交易记录
+    df.loc[rows + 6, 'viewed_time'] = np.nan
+    df.loc[rows + 7, ['transaction_time', 'amount']] = np.nan
+    df.loc[rows + 8, 'amount'] = np.nan
+    df.loc[rows + 9, ['viewed_time', 'transaction_time', 'amount']] = np.nan
+    return df
+
+def test_calc_valid_viewed_matches_row_function():
+    df = valid_frame()
+    expected = df.apply(is_valid_viewed, axis=1).values
+    assert expected.sum() > 0 and (expected == 0).sum() > 0
+    np.testing.assert_array_equal(calc_valid_viewed(df), expected)
+
+def test_calc_valid_comp_matches_row_function():
+    df = valid_frame()
+    expected = df.apply(is_valid_comp, axis=1).values
+    assert expected.sum() > 0 and (expected == 0).sum() > 0
+    np.testing.assert_array_equal(calc_valid_comp(df), expected)
+
+def test_calc_valid_boundaries():
+    df = pd.DataFrame({'received_time': [0., 0, 0, 0, 0, 0, 0],
+                       'viewed_time': [72., 0, 73, -1, np.nan, 10, 10],
+                       'transaction_time': [72., 0, 72, 72, 50, 9, np.nan],
+                       'duration_hour': [72, 72, 72, 72, 72, 72, 72],
+                       'amount': [10., 10, 10, 10, 10, 10, np.nan],
+                       'difficulty': [10, 10, 10, 10, 10, 10, 10]})
+    np.testing.assert_array_equal(calc_valid_viewed(df), [1, 1, 0, 0, 0, 1, 1])
+    np.testing.assert_array_equal(calc_valid_comp(df), [1, 1, 0, 1, 0, 0, 0])
+    for func, row_func in [(calc_valid_viewed, is_valid_viewed), (calc_valid_comp, is_valid_comp)]:
+        np.testing.assert_array_equal(func(df), df.apply(row_func, axis=1).values)
+
+
+### first_per_group：与原来稳定排序 + groupby.cumcount + query取第一行的结果一致，含取值相同、空值
+def cumcount_first(df, keys, by, ascending=True):
+    ''' 原来的写法：按by稳定排序，组内序号为1的行
+    '''
+    df = df.assign(rn = df.sort_values(by=[by], ascending=ascending, kind='mergesort')\
+                         .groupby(keys).cumcount()+1)
+    return df.query("rn==1").drop('rn', axis=1).reset_index(drop=True)
+
+def random_groups(seed, n=3000):
+    ''' 分组字段有空值、有Categorical，排序字段取值重复且有空值
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'cid': rng.choice(['a', 'b', 'c', 'd', None], n),
+                       'offer': pd.Categorical(rng.choice(['x', 'y', 'z'], n), categories=['w', 'x', 'y', 'z']),
+                       'received_time': rng.choice([0., 24, 48, np.nan], n),
+                       'value': rng.choice([1., 2, 3, np.nan], n),
+                       'rn_check': np.arange(n)}, index=rng.permutation(n) + 100)
+    df.loc[df.index[::50], 'offer'] = np.nan
+    return df
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('ascending', [True, False])
+@pytest.mark.parametrize('keys', [['cid'], ['offer'], ['cid', 'offer', 'received_time']])
+def test_first_per_group_matches_cumcount(seed, ascending, keys):
+    df = random_groups(seed)
+    pd.testing.assert_frame_equal(first_per_group(df, keys, 'value', ascending), \
+                                  cumcount_first(df, keys, 'value', ascending))
+
+def test_first_per_group_all_null_values():
+    # 组内全为空值时取靠前的行；空表
+    df = pd.DataFrame({'cid': ['a', 'a', 'b', 'b'], 'value': [np.nan, np.nan, np.nan, 1.]})
+    for ascending in [True, False]:
+        pd.testing.assert_frame_equal(first_per_group(df, ['cid'], 'value', ascending), \
+                                      cumcount_first(df, ['cid'], 'value', ascending))
+    assert len(first_per_group(df.iloc[:0], ['cid'], 'value')) == 0
+
+
+### match_first_transaction：与原来按cid连接全部交易、过滤后按comp_rn取第一笔的结果一致
+def merge_first_transaction(received_view, transaction):
+    ''' 原来的写法：按cid连接交易，保留有效交易，稳定排序后每条浏览记录取第一笔
+    '''
+    received_view_comp = pd.merge(received_view, transaction, how='left', on='cid')
+    received_view_comp['is_valid_comp'] = calc_valid_comp(received_view_comp)
+    received_view_comp = received_view_comp.query("is_valid_comp==1")
+    received_view_comp = received_view_comp.assign(comp_rn = received_view_comp\
+                                             .sort_values(by=['transaction_time'], kind='mergesort')\
+                                             .groupby(['cid','received_offer','received_time','viewed_time'])\
+                                             .cumcount()+1)
+    return received_view_comp.query("comp_rn==1").reset_index(drop=True)
+
+def assert_same_matches(received_view, transaction):
+    result = match_first_transaction(received_view, transaction)
+    expected = merge_first_transaction(received_view, transaction)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+def test_match_first_transaction_informational(tables):
+    received_info_view, _ = clean_received_info(tables['received_info'], tables['viewed'], tables['transaction'])
+    assert_same_matches(received_info_view, tables['transaction'])
+
+def test_match_first_transaction_difficulty_levels(tables):
+    # bogo和折扣offer的有效浏览有多个最低消费取值
+    received_other_view, _ = clean_received_other(tables['received_other'], tables['viewed'], tables['completed'])
+    assert received_other_view.difficulty.nunique() > 1
+    assert_same_matches(received_other_view, tables['transaction'])
+
+@pytest.mark.parametrize('seed', range(5))
+def test_match_first_transaction_random(seed):
+    # 交易时间重复、窗口边界、没有交易的用户
+    rng = np.random.default_rng(seed)
+    n_view, n_tr = 300, 1500
+    received_view = pd.DataFrame({'cid': rng.integers(0, 40, n_view).astype(str),
+                                  'received_offer': rng.integers(0, 5, n_view).astype(str),
+                                  'received_time': rng.integers(0, 20, n_view) * 24})
+    received_view['viewed_time'] = received_view['received_time'] + rng.integers(0, 72, n_view)
+    received_view['duration_hour'] = rng.choice([72, 120, 168], n_view)
+    received_view['difficulty'] = rng.choice([0, 5, 10, 20], n_view)
+    received_view = received_view.drop_duplicates(['cid','received_offer','received_time','viewed_time'])\
+                                 .reset_index(drop=True)
+    transaction = pd.DataFrame({'cid': rng.integers(0, 45, n_tr).astype(str),
+                                'transaction_time': rng.integers(0, 80, n_tr) * 6,
+                                'amount': np.round(rng.uniform(0, 25, n_tr), 2)})
+    assert_same_matches(received_view, transaction)
+
+
+### sep_df_chunked：分批读取json-lines，四张表与sep_df完全一致，含索引
+@pytest.mark.parametrize('chunksize', [7, 1000, 1000000])
+def test_sep_df_chunked_matches_sep_df(raw_data, tables, tmp_path, chunksize):
+    _, _, transcript = raw_data
+    path = str(tmp_path / 'transcript.json')
+    transcript.to_json(path, orient='records', lines=True)
+    result = sep_df_chunked(path, tables['portfolio'], chunksize=chunksize)
+    for df, name in zip(result, ['received', 'viewed', 'completed', 'transaction']):
+        assert len(tables[name]) > 0
+        pd.testing.assert_frame_equal(df, tables[name])
+
+
+### load_profile / load_portfolio：读取文件并清洗，取值与clean_profile / clean_portfolio一致，只有字段类型更紧凑
+COMPACT_DTYPES = {'gender': 'category', 'age': 'int8', 'became_member_on': 'int32', 'income': 'float32',
+                  'became_member_month': 'int8'}
+
+@pytest.mark.parametrize('chunksize', [97, 500000])
+def test_load_profile_matches_clean_profile(raw_data, tmp_path, chunksize):
+    _, profile, _ = raw_data
+    path = str(tmp_path / 'profile.json')
+    profile.to_json(path, orient='records', lines=True)
+    result = load_profile(path, chunksize=chunksize)
+    expected = clean_profile(pd.read_json(path, lines=True))
+    assert {col: str(result[col].dtype) for col in COMPACT_DTYPES} == COMPACT_DTYPES
+    pd.testing.assert_frame_equal(result.astype({'gender': object}), \
+                                  expected.astype({'gender': object}), check_dtype=False)
+
+def test_load_profile_encoded_ids(raw_data, tmp_path):
+    portfolio, profile, _ = raw_data
+    path = str(tmp_path / 'profile.json')
+    profile.to_json(path, orient='records', lines=True)
+    id_dtypes = build_id_dtypes(profile, portfolio)
+    pd.testing.assert_series_equal(load_profile(path, chunksize=97, id_dtypes=id_dtypes).cid, \
+                                   clean_profile(pd.read_json(path, lines=True), id_dtypes).cid)
+
+def test_load_portfolio_matches_clean_portfolio(raw_data, tmp_path):
+    portfolio, _, _ = raw_data
+    path = str(tmp_path / 'portfolio.json')
+    portfolio.to_json(path, orient='records', lines=True)
+    pd.testing.assert_frame_equal(load_portfolio(path), \
+                                  clean_portfolio(pd.read_json(path, lines=True)).rename(columns={'index':'offeridx'}))
+
+
+### encode_ids：不在id字典中的id报错，不能编码为空值
+def test_encode_ids_round_trip(raw_data):
+    portfolio, profile, transcript = raw_data
+    id_dtypes = build_id_dtypes(profile, portfolio)
+    encoded = encode_ids(transcript[['person', 'time']], id_dtypes)
+    assert isinstance(encoded.person.dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(decode_ids(encoded), transcript[['person', 'time']])
+
+def test_encode_ids_rejects_unknown_ids(raw_data):
+    portfolio, profile, transcript = raw_data
+    # 字典中缺少部分用户，如每日增量数据中的新注册用户
+    id_dtypes = build_id_dtypes(profile.iloc[100:], portfolio)
+    with pytest.raises(ValueError, match='person'):
+        encode_ids(transcript, id_dtypes)
+    with pytest.raises(ValueError):
+        sep_df(transcript.copy(), clean_portfolio(portfolio.copy(), id_dtypes), id_dtypes)
+
+
+### clean_response_sharded：与串行的clean_response结果完全一致，含行顺序和索引
+RESPONSE_INPUTS = ['received', 'viewed', 'completed', 'transaction', 'received_info', 'received_other']
+
+def assert_same_as_serial(inputs, **kwargs):
+    expected = clean_response(*inputs)
+    result = clean_response_sharded(*inputs, **kwargs)
+    for df, expected_df in zip(result, expected):
+        assert len(expected_df) > 0
+        pd.testing.assert_frame_equal(df, expected_df)
+
+@pytest.mark.parametrize('n_workers, shard_size', [(1, None), (1, 97), (3, None), (4, 97)])
+def test_clean_response_sharded_matches_serial(tables, n_workers, shard_size):
+    assert_same_as_serial([tables[name] for name in RESPONSE_INPUTS], n_workers=n_workers, shard_size=shard_size)
+
+def test_clean_response_sharded_empty_shards(tables):
+    # 每片约3个用户，按哈希分片时部分分片没有任何用户
+    cids = pd.concat([tables['received_other'].cid, tables['received_info'].cid, tables['transaction'].cid])
+    n_shards = math.ceil(cids.nunique() / 3)
+    shard_ids = pd.util.hash_pandas_object(cids, index=False).values % n_shards
+    assert len(np.unique(shard_ids)) < n_shards
+    assert_same_as_serial([tables[name] for name in RESPONSE_INPUTS], n_workers=2, shard_size=3)
+
+def test_clean_response_sharded_encoded_ids(raw_data):
+    # cid、offer id为Categorical编码
+    portfolio, profile, transcript = raw_data
+    id_dtypes = build_id_dtypes(profile, portfolio)
+    received, viewed, completed, transaction = sep_df(transcript.copy(), \
+                                                      clean_portfolio(portfolio.copy(), id_dtypes), id_dtypes)
+    assert isinstance(received.cid.dtype, pd.CategoricalDtype)
+    inputs = [received, viewed, completed, transaction, received.query("offer_type == 'informational'"), \
+              received.query("offer_type != 'informational'")]
+    assert_same_as_serial(inputs, n_workers=1, shard_size=50)
+    assert_same_as_serial(inputs, n_workers=3)
+
+
+### clean_cid_stats：与原来get_dummies + 三次groupby的写法结果一致
+def groupby_cid_stats(received_response_cid, transaction_response_cid):
+    ''' 原来的写法：offer类型展开为哑变量，按cid分别对接收、响应、交易记录groupby聚合
+    '''
+    received_response_cid1 = received_response_cid.join(pd.get_dummies(received_response_cid['offer_type']))
+    
+    cid_group1 = received_response_cid1.groupby("cid")
+    cid_group2 = received_response_cid1.query("is_response==1").groupby("cid")
+    cid_group3 = transaction_response_cid.groupby(["cid"])
+    
+    cid_stats1 =  cid_group1.agg({'received_time':'count',
+                'bogo':np.sum,
+                'discount':np.sum,
+                'informational':np.sum,
+                'social':np.sum,
+                'difficulty':[np.min,np.max,np.mean]
+                 })
+    cid_stats1.columns = ['_rece_'.join(col).strip() for col in cid_stats1.columns.values]
+    
+    cid_stats2 = cid_group2.agg({'bogo':np.sum,
+                    'discount':np.sum,
+                    'informational':np.sum,
+                    'social':np.sum,
+                    'difficulty':[np.min,np.max,np.mean],
+                    'amount':[np.min, np.max,np.mean,np.sum]
+                     })
+    cid_stats2.columns = ['_offer_'.join(col).strip() for col in cid_stats2.columns.values]
+    
+    cid_stats3 = cid_group3.agg({'amount':[np.min, np.max,np.mean,np.sum],
+                               'transaction_time':'count',
+                               'is_offer':'sum',
+                            })
+    cid_stats3.columns = ['_tr_'.join(col).strip() for col in cid_stats3.columns.values]
+    
+    return cid_stats3.join(cid_stats2).join(cid_stats1).reset_index()
+
+# 原来的offer类型计数为哑变量的uint8，超过255次会溢出，改为int64
+WIDENED_COLUMNS = {'bogo_rece_sum':'int64', 'discount_rece_sum':'int64', 'informational_rece_sum':'int64'}
+
+def assert_same_stats(result, expected):
+    assert list(result.columns) == list(expected.columns)
+    # 有用户没有接收记录时，两种写法的计数都为含空值的float
+    widened = {col: dtype for col, dtype in WIDENED_COLUMNS.items() if expected[col].dtype == np.uint8}
+    pd.testing.assert_frame_equal(result, expected.astype(widened), check_exact=False, rtol=1e-9)
+
+@pytest.fixture(scope='module')
+def response_cid(tables):
+    _, _, transaction_response, _, received_response = \
+        clean_response(*[tables[name] for name in RESPONSE_INPUTS])
+    profile = tables['profile']
+    return pd.merge(received_response, profile, on='cid'), pd.merge(transaction_response, profile, on='cid')
+
+def test_clean_cid_stats_matches_groupby(response_cid):
+    received_response_cid, transaction_response_cid = response_cid
+    result = clean_cid_stats(received_response_cid, transaction_response_cid)
+    expected = groupby_cid_stats(received_response_cid, transaction_response_cid)
+    # 有没有响应过任何offer的用户，这些用户的响应统计为空
+    assert result['amount_offer_sum'].isna().any() and result['amount_offer_sum'].notna().any()
+    assert_same_stats(result, expected)
+
+def test_clean_cid_stats_subsets(response_cid):
+    # 交易用户多于接收用户、没有任何响应记录
+    received_response_cid, transaction_response_cid = response_cid
+    received_cids = received_response_cid.cid.unique()
+    cases = [(received_response_cid[received_response_cid.cid.isin(received_cids[::2])], transaction_response_cid),
+             (received_response_cid.assign(is_response=0), transaction_response_cid)]
+    for received_df, transaction_df in cases:
+        result = clean_cid_stats(received_df, transaction_df)
+        expected = groupby_cid_stats(received_df, transaction_df)
+        assert_same_stats(result, expected)
@@ -0,0 +1,51 @@
+import pandas as pd
+import pytest
+
+from clean_data import clean_response, clean_cid_stats, add_feature_cols, find_cid_groups
+from cohort import build_cube, query_cube, DIMENSIONS, RATIO_COLUMNS, CONTINUOUS_COLUMNS
+
+
+### 立方体查询：与find_cid_groups扫描用户特征表的结果一致
+@pytest.fixture(scope='module')
+def cid_profile(tables):
+    _, _, transaction_response, _, received_response = \
+        clean_response(*[tables[name] for name in ['received', 'viewed', 'completed', 'transaction', \
+                                                   'received_info', 'received_other']])
+    profile = tables['profile']
+    cid_stats = clean_cid_stats(pd.merge(received_response, profile, on='cid'), \
+                                pd.merge(transaction_response, profile, on='cid'))
+    return pd.merge(add_feature_cols(cid_stats), profile, on='cid')
+
+def assert_same_groups(cube, df, metric, condition, feature_groups):
+    expected = find_cid_groups(df, feature_groups, metric, condition)
+    result = query_cube(cube, metric, condition, feature_groups)
+    pd.testing.assert_frame_equal(result[0], expected[0], check_exact=False, rtol=1e-9)
+    pd.testing.assert_frame_equal(result[1], expected[1], check_exact=False, rtol=1e-9)
+    for col in feature_groups:
+        pd.testing.assert_series_equal(result[2][col], expected[2][col])
+
+@pytest.mark.parametrize('condition', ['==1', '>0.5', '==0', '<0.3'])
+@pytest.mark.parametrize('feature_groups', [DIMENSIONS, ['gender', 'age_range'], ['income_range']])
+def test_query_cube_matches_find_cid_groups(cid_profile, condition, feature_groups):
+    cube = build_cube(cid_profile)
+    for metric in RATIO_COLUMNS:
+        assert_same_groups(cube, cid_profile, metric, condition, feature_groups)
+
+def test_continuous_metrics_on_request(cid_profile):
+    # 连续取值的指标默认不预聚合，指定时结果仍然精确，但格子数接近用户数
+    assert not set(CONTINUOUS_COLUMNS) & set(build_cube(cid_profile)['metrics'])
+    with pytest.raises(ValueError):
+        query_cube(build_cube(cid_profile), 'offer_amount_ratio', '>0.5')
+    cube = build_cube(cid_profile, metrics=CONTINUOUS_COLUMNS)
+    for metric in CONTINUOUS_COLUMNS:
+        assert_same_groups(cube, cid_profile, metric, '>0.5', DIMENSIONS)
+    assert len(cube['metrics']['offer_amount_ratio']) > 0.5 * cid_profile['offer_amount_ratio'].notna().sum()
+
+@pytest.mark.parametrize('feature_groups', [['gender', 'became_member_month'], ['became_member_month'], \
+                                            ['gender', 'became_member_month', 'age_range']])
+def test_query_cube_non_categorical_dimensions(cid_profile, feature_groups):
+    # 维度都不是Categorical时groupby只输出出现过的组合，有Categorical维度时输出全部组合
+    df = cid_profile.astype({'gender': object})
+    cube = build_cube(df, dimensions=feature_groups)
+    for condition in ['==1', '>0.5', '<0.3']:
+        assert_same_groups(cube, df, 'bogo_offer_ratio', condition, feature_groups)
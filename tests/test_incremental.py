@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from clean_data import clean_portfolio, clean_profile, sep_df, clean_response, clean_cid_stats, add_feature_cols
+import incremental
+
+
+### 增量更新：按时间切片逐批update，结果与对全部记录重新计算一致
+def full_recompute(transcript, portfolio, profile):
+    ''' 全量计算：sep_df → clean_response → clean_cid_stats → add_feature_cols
+    '''
+    received, viewed, completed, transaction = sep_df(transcript.copy(), portfolio)
+    received_info = received.query("offer_type == 'informational'")
+    received_other = received.query("offer_type != 'informational'")
+    _, _, transaction_response, _, received_response = \
+        clean_response(received, viewed, completed, transaction, received_info, received_other)
+    cid_stats = clean_cid_stats(pd.merge(received_response, profile, on='cid'), \
+                                pd.merge(transaction_response, profile, on='cid'))
+    return received_response, transaction_response, add_feature_cols(cid_stats)
+
+def run_slices(transcript, portfolio, profile, hours, state_path=None):
+    ''' 按hours小时切片逐批增量更新，state_path不为空时每批之间保存、读取状态
+    '''
+    state = incremental.init_state()
+    for start in np.arange(transcript.time.min(), transcript.time.max() + 1, hours):
+        # 没有记录的切片也调用update，状态应保持不变
+        batch = transcript[(transcript.time >= start) & (transcript.time < start + hours)]
+        state, received_response, transaction_response, cid_stats = \
+            incremental.update(state, batch, portfolio, profile)
+        if state_path is not None:
+            incremental.save_state(state, state_path)
+            state = incremental.load_state(state_path)
+    return received_response, transaction_response, cid_stats
+
+@pytest.fixture(scope='module')
+def cleaned(raw_data):
+    portfolio, profile, transcript = raw_data
+    portfolio = clean_portfolio(portfolio.copy()).rename(columns={'index':'offeridx'})
+    profile = clean_profile(profile.copy())
+    return transcript, portfolio, profile, full_recompute(transcript, portfolio, profile)
+
+@pytest.mark.parametrize('hours', [6, 24, 72, 100])
+def test_update_matches_full_recompute(cleaned, hours):
+    transcript, portfolio, profile, expected = cleaned
+    result = run_slices(transcript, portfolio, profile, hours)
+    for df, expected_df in zip(result, expected):
+        assert len(expected_df) > 0
+        pd.testing.assert_frame_equal(df, expected_df)
+
+def test_update_with_persisted_state(cleaned, tmp_path):
+    transcript, portfolio, profile, expected = cleaned
+    result = run_slices(transcript, portfolio, profile, 48, state_path=str(tmp_path / 'state.pkl'))
+    for df, expected_df in zip(result, expected):
+        pd.testing.assert_frame_equal(df, expected_df)
+
+def test_update_rejects_old_records(cleaned):
+    transcript, portfolio, profile, _ = cleaned
+    state, _, _, _ = incremental.update(incremental.init_state(), transcript[transcript.time < 200], \
+                                        portfolio, profile)
+    with pytest.raises(ValueError):
+        incremental.update(state, transcript[transcript.time >= 100], portfolio, profile)
+
+def test_update_empty_slices(cleaned):
+    transcript, portfolio, profile, expected = cleaned
+    empty = transcript.iloc[:0]
+
+    # 尚未处理过任何记录时，空切片不产生输出
+    state, received_response, _, _ = incremental.update(incremental.init_state(), empty, portfolio, profile)
+    assert received_response is None and state['watermark'] is None
+
+    state, _, _, _ = incremental.update(state, transcript[transcript.time < 300], portfolio, profile)
+    watermark = state['watermark']
+    state, received_response, transaction_response, cid_stats = \
+        incremental.update(state, empty, portfolio, profile)
+    assert state['watermark'] == watermark
+
+    # 空切片之后，重放已处理的记录仍然报错
+    with pytest.raises(ValueError):
+        incremental.update(state, transcript[transcript.time < 10], portfolio, profile)
+
+    result = incremental.update(state, transcript[transcript.time >= 300], portfolio, profile)[1:]
+    for df, expected_df in zip(result, expected):
+        pd.testing.assert_frame_equal(df, expected_df)
@@ -0,0 +1,27 @@
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+from instrument import instrument as record_stages, reset_worker, summarize
+from clean_data import clean_response_sharded
+
+
+### 性能记录：进程池子进程中关闭记录，主进程照常记录
+def worker_state(_):
+    return instrument.ACTIVE is None, tracemalloc.is_tracing()
+
+def test_reset_worker_disables_recording():
+    with record_stages():
+        assert instrument.ACTIVE is not None and tracemalloc.is_tracing()
+        with ProcessPoolExecutor(max_workers=2, initializer=reset_worker) as executor:
+            states = list(executor.map(worker_state, range(4)))
+    assert states == [(True, False)] * 4
+
+def test_sharded_records_parent_calls_only(tables):
+    inputs = [tables[name] for name in ['received', 'viewed', 'completed', 'transaction', \
+                                        'received_info', 'received_other']]
+    with record_stages() as records:
+        clean_response_sharded(*inputs, n_workers=2)
+    report = summarize(records)
+    assert set(report.index) == {'clean_response_sharded', 'match_response'}
+    assert instrument.ACTIVE is None
@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+
+from clean_data import load_portfolio, load_profile, sep_df_chunked, clean_response, clean_cid_stats, \
+                       add_feature_cols, find_cid_groups
+from pipeline import LazyPipeline
+from synthetic_data import write_dataset
+
+
+### LazyPipeline：裁剪字段、推迟连接活动信息后，各输出与逐步执行的清洗流程一致
+FEATURE_GROUPS = ['gender', 'age_range', 'income_range', 'became_member_year']
+OUTPUTS = ['portfolio', 'profile', 'received', 'viewed', 'completed', 'transaction',
+           'received_response', 'transaction_response', 'cid_stats', 'cid_features']
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    ''' 写出模拟数据文件，并逐步执行清洗流程作为对照
+    '''
+    paths = write_dataset(str(tmp_path_factory.mktemp('data')), 800, seed=5, block_size=300)
+    portfolio = load_portfolio(paths['portfolio'])
+    profile = load_profile(paths['profile'])
+    received, viewed, completed, transaction = sep_df_chunked(paths['transcript'], portfolio)
+    received_info = received.query("offer_type == 'informational'")
+    received_other = received.query("offer_type != 'informational'")
+    _, _, transaction_response, _, received_response = \
+        clean_response(received, viewed, completed, transaction, received_info, received_other)
+    cid_stats = clean_cid_stats(pd.merge(received_response, profile, on='cid'), \
+                                pd.merge(transaction_response, profile, on='cid'))
+    cid_features = add_feature_cols(cid_stats.copy())
+    eager = {'portfolio': portfolio, 'profile': profile, 'received': received, 'viewed': viewed,
+             'completed': completed, 'transaction': transaction, 'received_response': received_response,
+             'transaction_response': transaction_response, 'cid_stats': cid_stats, 'cid_features': cid_features,
+             'cid_groups': find_cid_groups(pd.merge(cid_features, profile, on='cid'), FEATURE_GROUPS, \
+                                           'bogo_offer_ratio', '>0.5')}
+    return paths, eager
+
+def pipeline(paths, **kwargs):
+    return LazyPipeline(paths['portfolio'], paths['profile'], paths['transcript'], chunksize=500, **kwargs)
+
+@pytest.mark.parametrize('encode_ids', [False, True])
+def test_collect_all_outputs(dataset, encode_ids):
+    paths, eager = dataset
+    plan = pipeline(paths, encode_ids=encode_ids)
+    for output in OUTPUTS:
+        plan.select(output)
+    results = plan.cid_groups(FEATURE_GROUPS, 'bogo_offer_ratio', '>0.5').collect()
+    for output in OUTPUTS:
+        assert len(eager[output]) > 0
+        pd.testing.assert_frame_equal(results[output], eager[output])
+    for result, expected in zip(results['cid_groups'], eager['cid_groups']):
+        if isinstance(expected, dict):
+            for col in FEATURE_GROUPS:
+                pd.testing.assert_series_equal(result[col], expected[col])
+        else:
+            pd.testing.assert_frame_equal(result, expected)
+
+@pytest.mark.parametrize('encode_ids', [False, True])
+def test_collect_pruned_columns(dataset, encode_ids):
+    # 只请求部分输出和字段时，只连接用到的活动字段，结果仍然一致
+    paths, eager = dataset
+    columns = ['cid', 'received_offer', 'is_response']
+    plan = pipeline(paths, encode_ids=encode_ids).select('received_response', columns).select('cid_features')
+    assert plan.stages() == ['portfolio', 'profile', 'events', 'response', 'cid_stats', 'cid_features']
+    assert 'email' not in plan.explain()['portfolio_columns']
+    results = plan.collect()
+    pd.testing.assert_frame_equal(results['received_response'], eager['received_response'][columns])
+    pd.testing.assert_frame_equal(results['cid_features'], eager['cid_features'])
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from whatif import OfferSimulation, attribute, COHORT_DIMENSIONS
+
+
+### offer参数模拟：只重新归因受影响的用户，结果与修改接收记录中的offer参数后全量重新归因一致
+@pytest.fixture(scope='module')
+def simulation(tables):
+    portfolio = tables['portfolio']
+    offers = {offer_type: portfolio.loc[portfolio.offer_type == offer_type, 'offerid'].tolist() \
+              for offer_type in ['bogo', 'discount', 'informational']}
+    duration = dict(zip(portfolio.offerid, portfolio.duration_day))
+    variants = [{},
+                {offers['bogo'][0]: {'duration_day': 3}},
+                {offers['bogo'][1]: {'difficulty': 3}},
+                {offers['discount'][0]: {'reward': 10, 'difficulty': 5}, offers['informational'][0]: {'duration_day': 1},
+                 offers['bogo'][0]: {'duration_day': 10}},
+                {offers['bogo'][0]: {'duration_day': duration[offers['bogo'][0]]}}]
+    sim = OfferSimulation(tables['received'], tables['viewed'], tables['transaction'], tables['profile'])
+    return variants, sim.evaluate(variants, batch_size=2)
+
+def full_attribution(tables, changes):
+    ''' 全量重新归因：在接收记录上直接修改offer参数
+    '''
+    received = tables['received'].copy()
+    for offer, params in changes.items():
+        for param, value in params.items():
+            received.loc[received.received_offer == offer, param] = value
+    received['duration_hour'] = received['duration_day'] * 24
+    return attribute(received, tables['viewed'], tables['transaction'])
+
+def test_evaluate_matches_full_attribution(tables, simulation):
+    variants, (offer_rates, cohort_rates) = simulation
+    base = attribute(tables['received'], tables['viewed'], tables['transaction'])
+    profile = tables['profile'].set_index('cid')
+    for variant_id, changes in enumerate(variants):
+        received_response = full_attribution(tables, changes)
+        rates = offer_rates[offer_rates.variant_id == variant_id].set_index('received_offer')
+        expected = received_response.groupby('received_offer').is_response.mean()
+        np.testing.assert_allclose(rates.rate.reindex(expected.index).values, expected.values)
+        expected_base = base.groupby('received_offer').is_response.mean()
+        np.testing.assert_allclose(rates.base_rate.reindex(expected_base.index).values, expected_base.values)
+
+        for dim in COHORT_DIMENSIONS:
+            levels = profile[dim].reindex(received_response.cid.values).values
+            expected = received_response.assign(level=levels).groupby('level', observed=True).is_response.mean()
+            rates = cohort_rates[(cohort_rates.variant_id == variant_id) & (cohort_rates.dimension == dim)]\
+                        .set_index('level')
+            np.testing.assert_allclose(rates.rate.reindex(expected.index).values.astype(float), expected.values)
+
+def test_evaluate_deltas(simulation):
+    variants, (offer_rates, cohort_rates) = simulation
+    # 不修改参数、参数改为原值时差值为0；修改参数的变体有变化
+    for variant_id in [0, 4]:
+        assert (offer_rates[offer_rates.variant_id == variant_id].delta == 0).all()
+        assert (cohort_rates[cohort_rates.variant_id == variant_id].delta == 0).all()
+    for variant_id in [1, 2, 3]:
+        assert (offer_rates[offer_rates.variant_id == variant_id].delta != 0).any()
+    assert sorted(offer_rates.variant_id.unique()) == list(range(len(variants)))
+
+def test_evaluate_rejects_unknown_params(tables):
+    sim = OfferSimulation(tables['received'], tables['viewed'], tables['transaction'])
+    offer = tables['received'].received_offer.iloc[0]
+    with pytest.raises(ValueError):
+        sim.evaluate([{offer: {'channels': 1}}])
+    with pytest.raises(ValueError):
+        sim.evaluate([{'unknown-offer': {'reward': 1}}])
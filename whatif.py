@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+
+from clean_data import match_first_transaction, clean_response
+
+
+### offer参数的模拟评估：修改某些offer的有效期、最低消费、reward后，响应率如何变化
+# 只重新归因收到并浏览过被修改offer的用户，多个变体叠加在同一批表上一次计算
+# 可修改的offer参数
+VARIANT_PARAMS = ['duration_day', 'difficulty', 'reward']
+# clean_profile输出的用户分段
+COHORT_DIMENSIONS = ['gender', 'age_range', 'income_range', 'became_member_year']
+
+
+def derive_completed(received, transaction):
+    ''' 按offer参数推导bogo和折扣offer的完成记录：接收后有效期内第一笔金额达标的交易
+    Args:
+        received (df): offer接收记录，含duration_hour、difficulty字段
+        transaction (df): 用户交易记录
+    Returns:
+        completed (df): 完成offer记录，字段同join_completed的输出
+    '''
+    other = received[received.offer_type.values != 'informational']
+    completed = match_first_transaction(other.assign(viewed_time=other['received_time']), \
+                                        transaction[['cid', 'transaction_time', 'amount']])
+    return completed[['cid', 'received_offer', 'transaction_time', 'amount']]\
+                .rename(columns={'received_offer':'completed_offer'}).drop_duplicates().reset_index(drop=True)
+
+def attribute(received, viewed, transaction):
+    ''' 用推导的完成记录做响应归因
+    Args:
+        received, viewed, transaction (df): 同clean_response
+    Returns:
+        received_response (df): 接收-offer响应联合表，同clean_response
+    '''
+    received_info = received.query("offer_type == 'informational'")
+    received_other = received.query("offer_type != 'informational'")
+    completed = derive_completed(received, transaction)
+    return clean_response(received, viewed, completed, transaction, received_info, received_other)[4]
+
+
+class OfferSimulation:
+    ''' offer参数的模拟评估。初始化时建立用户到记录的索引并计算基准归因，evaluate时只对收到并浏览过被修改offer的
+        用户重新归因，结果与修改活动信息后全量重新计算一致。
+        bogo和折扣offer的完成记录按参数推导(derive_completed)，基准也按同一规则计算，因此不修改参数时差值为0
+    '''
+    def __init__(self, received, viewed, transaction, profile=None):
+        '''
+        Args:
+            received (df): sep_df输出的offer接收记录，已连接活动信息
+            viewed (df): sep_df输出的浏览offer记录
+            transaction (df): sep_df输出的交易记录
+            profile (df): clean_profile输出的用户信息，传入时按用户分段计算响应率
+        '''
+        # 用户、offer编码为整数，变体叠加时用 变体编号*用户数+用户编码 区分
+        self.cids = pd.Index(pd.unique(np.concatenate([np.asarray(received.cid), np.asarray(viewed.cid), \
+                                                       np.asarray(transaction.cid)])))
+        self.offers = pd.Index(pd.unique(np.asarray(received.received_offer)))
+        self.tables = {name: df.assign(cid=self.cids.get_indexer(np.asarray(df.cid))).reset_index(drop=True) \
+                       for name, df in [('received', received), ('viewed', viewed), ('transaction', transaction)]}
+        self.tables['received'] = self.tables['received'].assign(\
+            received_offer=self.offers.get_indexer(np.asarray(received.received_offer)), \
+            offer_type=pd.Categorical(received.offer_type))
+        self.tables['viewed'] = self.tables['viewed'].assign(\
+            viewed_offer=self.offers.get_indexer(np.asarray(viewed.viewed_offer)))
+        self.tables['received_response'] = attribute(*[self.tables[name] for name in \
+                                                       ['received', 'viewed', 'transaction']])
+
+        # 每张表按用户编码排序的行号，用于按用户取出全部记录
+        self.index = {}
+        for name, df in self.tables.items():
+            order = np.argsort(df.cid.values, kind='stable')
+            self.index[name] = (order, df.cid.values[order])
+
+        # 每个offer既有接收又有浏览记录的用户；没有浏览记录时，无论参数如何该offer都不会被响应，修改参数不影响归因
+        received, viewed = self.tables['received'], self.tables['viewed']
+        self.offer_cids = {offer: np.intersect1d(received.cid.values[received.received_offer.values == code], \
+                                                 viewed.cid.values[viewed.viewed_offer.values == code]) \
+                           for code, offer in enumerate(self.offers)}
+
+        # 每个用户的分段
+        self.cohorts = None
+        if profile is not None:
+            self.cohorts = profile.assign(cid=np.asarray(profile.cid)).drop_duplicates('cid').set_index('cid')\
+                                  .reindex(self.cids)[COHORT_DIMENSIONS].reset_index(drop=True)
+
+    def stack(self, name, variant_ids, cid_codes):
+        ''' 按(变体, 用户)取出用户的全部记录，用户编码换为叠加后的编码
+        Args:
+            name (string): 表名
+            variant_ids, cid_codes (np.array): 每个变体需要重新归因的用户
+        Returns:
+            stacked (df): 叠加后的记录，增加variant_id字段
+        '''
+        order, sorted_codes = self.index[name]
+        starts = np.searchsorted(sorted_codes, cid_codes, side='left')
+        lengths = np.searchsorted(sorted_codes, cid_codes, side='right') - starts
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = order[np.repeat(starts, lengths) + offsets]
+        variants = np.repeat(variant_ids, lengths)
+        stacked = self.tables[name].iloc[rows]
+        return stacked.assign(cid=variants * len(self.cids) + stacked.cid.values, variant_id=variants)\
+                      .reset_index(drop=True)
+
+    def evaluate_batch(self, variants, first_id):
+        ''' 一批变体叠加后一次归因，返回每个变体相对基准的响应次数变化
+        Args:
+            variants (list): 变体，见evaluate
+            first_id (int): 第一个变体的编号
+        Returns:
+            diff (df): 每条接收记录的响应变化，含variant_id、cid(原用户编码)、received_offer、is_response
+        '''
+        variant_ids, cid_codes = [], []
+        for i, changes in enumerate(variants):
+            for offer, params in changes.items():
+                if offer not in self.offer_cids:
+                    raise ValueError('没有offer {}的接收记录'.format(offer))
+                unknown = set(params) - set(VARIANT_PARAMS)
+                if unknown:
+                    raise ValueError('只能修改{}，不能修改{}'.format(VARIANT_PARAMS, sorted(unknown)))
+            cids = np.unique(np.concatenate([self.offer_cids[offer] for offer in changes] + [[]])).astype(int)
+            variant_ids.append(np.full(len(cids), first_id + i))
+            cid_codes.append(cids)
+        variant_ids, cid_codes = np.concatenate(variant_ids), np.concatenate(cid_codes)
+
+        # 叠加各变体的记录，修改变体中的offer参数
+        received = self.stack('received', variant_ids, cid_codes)
+        for i, changes in enumerate(variants):
+            for offer, params in changes.items():
+                rows = (received.variant_id.values == first_id + i) \
+                       & (received.received_offer.values == self.offers.get_loc(offer))
+                for param, value in params.items():
+                    received.loc[rows, param] = value
+        received['duration_hour'] = received['duration_day'] * 24
+        viewed = self.stack('viewed', variant_ids, cid_codes)
+        transaction = self.stack('transaction', variant_ids, cid_codes)
+
+        # 变体的归因结果减去这些用户的基准结果
+        response = attribute(received.drop('variant_id', axis=1), viewed.drop('variant_id', axis=1), \
+                             transaction.drop('variant_id', axis=1))
+        response = response.assign(variant_id=response.cid.values // len(self.cids), \
+                                   cid=response.cid.values % len(self.cids))
+        baseline = self.stack('received_response', variant_ids, cid_codes)
+        baseline = baseline.assign(cid=baseline.cid.values % len(self.cids), is_response=-baseline.is_response)
+        columns = ['variant_id', 'cid', 'received_offer', 'is_response']
+        return pd.concat([response[columns], baseline[columns]], ignore_index=True)
+
+    def evaluate(self, variants, batch_size=50):
+        ''' 评估一批offer参数变体
+        Args:
+            variants (list): 变体list，每个变体为{offer id: {参数名: 取值}}，参数见VARIANT_PARAMS，
+                             如[{'ae264e3637204a6fb9bb56bc8210ddfd': {'duration_day': 5}}]，变体编号为list中的位置
+            batch_size (int): 每批叠加计算的变体数，决定内存上限
+        Returns:
+            offer_rates (df): 每个变体、每个offer的接收次数、基准响应率、变体响应率、差值
+            cohort_rates (df): 每个变体、每个用户分段的接收次数、基准响应率、变体响应率、差值，未传入profile时为None
+        '''
+        batches = [self.evaluate_batch(variants[start:start + batch_size], start) \
+                   for start in range(0, len(variants), batch_size)]
+        diff = pd.concat(batches, ignore_index=True) if batches else None
+        base = self.tables['received_response']
+        variant_index = pd.Index(np.arange(len(variants)), name='variant_id')
+
+        def rates(base_keys, diff_keys, name):
+            # 基准响应率，加上每个变体的响应次数变化
+            base_stats = base.groupby(base_keys, observed=True).is_response.agg(['count', 'mean'])\
+                             .rename(columns={'count':'received', 'mean':'base_rate'})
+            delta = pd.Series(0, index=pd.MultiIndex.from_product([variant_index, base_stats.index]))
+            if diff is not None and len(diff):
+                delta = delta.add(diff.groupby([diff.variant_id] + diff_keys, observed=True).is_response.sum(), \
+                                  fill_value=0)
+            result = delta.rename('delta').reset_index()
+            result.columns = ['variant_id', name, 'delta']
+            result = result.merge(base_stats, left_on=name, right_index=True)
+            result['delta'] = result['delta'] / result['received']
+            result['rate'] = result['base_rate'] + result['delta']
+            return result[['variant_id', name, 'received', 'base_rate', 'rate', 'delta']]
+
+        offer_rates = rates([base.received_offer], [diff.received_offer] if diff is not None else [], \
+                            'received_offer')
+        offer_rates['received_offer'] = self.offers[offer_rates.received_offer.values]
+
+        cohort_rates = None
+        if self.cohorts is not None:
+            parts = []
+            for dim in COHORT_DIMENSIONS:
+                levels = self.cohorts[dim]
+                base_level = levels.iloc[base.cid.values].reset_index(drop=True)
+                diff_level = [levels.iloc[diff.cid.values].reset_index(drop=True)] if diff is not None else []
+                part = rates([base_level], diff_level, 'level')
+                parts.append(part.assign(dimension=dim))
+            cohort_rates = pd.concat(parts, ignore_index=True)\
+                             [['variant_id', 'dimension', 'level', 'received', 'base_rate', 'rate', 'delta']]
+
+        return offer_rates, cohort_rates